@@ -1,9 +1,20 @@
 import streamlit as st
 import google.generativeai as genai
-import fitz  # PyMuPDF
-import re
+from google.ai import generativelanguage as glm
+import time
 from io import BytesIO
 
+from arabic_text import normalize_pages
+from exam_export import build_exam_files
+from llm_cache import ResponseCache
+from pdf_cache import PDFCache, document_hash
+from pdf_tools import iter_pages, open_pdf, select_pages
+from prompt_budget import PromptBuilder
+from question_bank import QuestionBank
+from question_generator import iter_questions, requested_count
+from question_store import QuestionStore, paginate
+from retrieval import BM25Index
+
 # --- Page Config ---
 st.set_page_config(
     page_title="Q-BANK PRO",
@@ -44,39 +55,138 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# --- Limits ---
+# Uploads above server.maxUploadSize (.streamlit/config.toml) are refused before they are read
+MAX_FILE_SIZE = 50 * 1024 * 1024
+# Longer documents are sampled evenly across all pages
+MAX_PDF_PAGES = 300
+# Token budgets per request: a larger context costs more and answers slower
+CONTEXT_TOKENS = 8000
+MAX_OUTPUT_TOKENS = 8192
+
 # --- Session State Initialization ---
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "pdf_text" not in st.session_state:
     st.session_state.pdf_text = ""
+if "pdf_file_id" not in st.session_state:
+    st.session_state.pdf_file_id = None
+if "pdf_hash" not in st.session_state:
+    st.session_state.pdf_hash = ""
 if "questions" not in st.session_state:
-    st.session_state.questions = []
+    st.session_state.questions = QuestionStore()
 
 # --- Helper Functions ---
-def extract_text_from_pdf(uploaded_file):
+@st.cache_resource
+def get_pdf_cache():
+    # One cache per server process. The disk tier's clean_text entries are shared
+    # with batch_generate.py; the bot keeps its own per-page ingest entries there
+    return PDFCache()
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache()
+
+@st.cache_resource
+def get_prompt_builder():
+    # Shared token counting and per-request usage log for the whole server
+    return PromptBuilder({"gemini": CONTEXT_TOKENS}, {"gemini": MAX_OUTPUT_TOKENS})
+
+@st.cache_resource(max_entries=8)
+def get_document_index(doc_hash, _text):
+    return BM25Index.from_text(_text)
+
+@st.cache_resource
+def get_question_bank():
+    # Persistent across sessions, so stored questions are reused instead of regenerated
+    return QuestionBank()
+
+def stream_cached(model, prompt, document, use_cache=True):
+    # Yields the reply as it is generated; identical prompt + document + model
+    # is answered from the persistent cache in one piece
+    response_cache = get_response_cache()
+    cache_key = ResponseCache.make_key("gemini", model.model_name, prompt, document)
+    if use_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+    parts = []
+    usage = None
+    started = time.monotonic()
+    for chunk in model.generate_content(prompt, stream=True):
+        # Every chunk carries the running totals; the last one holds the final counts
+        usage = chunk.usage_metadata or usage
+        parts.append(chunk.text)
+        yield chunk.text
+    reply = "".join(parts)
+    get_prompt_builder().record(
+        "gemini", model.model_name, prompt, reply, time.monotonic() - started,
+        usage.prompt_token_count if usage else None, usage.candidates_token_count if usage else None
+    )
+    response_cache.set(cache_key, reply)
+
+@st.cache_resource
+def get_model(api_key, model_name="gemini-1.5-flash"):
+    # Built once per key and reused by every rerun. genai.configure() is process-wide and a
+    # model picks up whichever key is configured at its first request, so each cached model
+    # gets its own client bound to its key instead. google-generativeai has no public
+    # per-model client, so this sets the private _client that generate_content uses;
+    # the version is pinned in requirements.txt for that reason
+    model = genai.GenerativeModel(model_name, generation_config={"max_output_tokens": MAX_OUTPUT_TOKENS})
+    model._client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    return model
+
+def read_pdf_pages(pdf_data, progress=None):
+    # Pages are streamed one at a time and joined once by the caller. This is not
+    # wrapped in st.cache_data: a cache hit would replay the progress calls on an
+    # element from an earlier run and fail; repeat uploads hit the PDF cache instead
+    doc = open_pdf(pdf_data)
     try:
-        doc = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-        text = ""
-        for page in doc:
-            text += page.get_text() + "\n"
+        page_numbers = select_pages(len(doc), MAX_PDF_PAGES, sample=True)
+        page_count = len(page_numbers)
+        pages = []
+        for page_num, page_text in enumerate(iter_pages(doc, page_numbers)):
+            pages.append(page_text)
+            if progress is not None:
+                progress.progress((page_num + 1) / page_count, text=f"صفحة {page_num + 1} من {page_count}")
+        return pages, len(doc)
+    finally:
+        doc.close()
+
+def extract_text_from_pdf(uploaded_file, progress=None):
+    if uploaded_file.size > MAX_FILE_SIZE:
+        st.error(f"حجم الملف أكبر من الحد المسموح ({MAX_FILE_SIZE // (1024 * 1024)}MB)")
+        return None
+    try:
+        # Zero-copy view of the upload; hashed and parsed without duplicating it
+        pdf_data = uploaded_file.getbuffer()
+        doc_hash = document_hash(pdf_data)
+        # Keyed by the content hash: repeat uploads in any session skip parsing
+        # (memory tier), and the disk tier covers server restarts
+        pdf_cache = get_pdf_cache()
+        cache_key = PDFCache.make_key(doc_hash, "clean_text", max_pages=MAX_PDF_PAGES)
+        text = pdf_cache.get(cache_key)
+        if text is None:
+            pages, total_pages = read_pdf_pages(pdf_data, progress)
+            # Headers/footers, tashkeel and repeated paragraphs are dropped once here
+            clean_pages, cleaning = normalize_pages(pages)
+            text = "\n".join(clean_pages)
+            pdf_cache.set(cache_key, text)
+            if len(pages) < total_pages:
+                st.info(f"الملف يحتوي {total_pages} صفحة، سيتم استخدام {len(pages)} صفحة موزعة على كامل الملف.")
+            if cleaning["tokens_saved"] > 0:
+                st.caption(f"تم توفير ~{cleaning['tokens_saved']} رمز ({cleaning['bytes_saved'] // 1024}KB) بحذف التكرار والتشكيل")
+        st.session_state.pdf_hash = doc_hash
         return text
     except Exception as e:
         st.error(f"خطأ في قراءة الملف: {e}")
         return None
 
-def parse_questions(text):
-    regex = r":::سؤال:::([\s\S]*?):::نهاية:::"
-    matches = re.findall(regex, text)
-    new_questions = []
-    for match in matches:
-        parts = [p.strip() for p in match.split('||')]
-        if len(parts) >= 3:
-            new_questions.append({
-                "question": parts[0],
-                "options": parts[1:-1],
-                "answer": parts[-1]
-            })
-    return new_questions
+@st.cache_data(max_entries=16, show_spinner=False)
+def export_exam(set_hash, title, forms, _questions):
+    # Keyed by the question-set hash, so repeated downloads reuse the rendered files
+    return build_exam_files(_questions, title, forms)
 
 # --- Sidebar ---
 with st.sidebar:
@@ -84,17 +194,20 @@ with st.sidebar:
     
     # API Key Handling
     api_key = st.text_input("Gemini API Key", type="password", placeholder="ضع المفتاح هنا...")
-    if api_key:
-        genai.configure(api_key=api_key)
     
     st.markdown("---")
     
     # Upload
     uploaded_file = st.file_uploader("رفع ملف PDF", type=['pdf'])
-    if uploaded_file and not st.session_state.pdf_text:
+    # Only a newly selected file is processed; other reruns reuse the session text
+    if uploaded_file and uploaded_file.file_id != st.session_state.pdf_file_id:
         with st.spinner("جاري استخراج النصوص (PyMuPDF)..."):
-            text = extract_text_from_pdf(uploaded_file)
+            progress = st.progress(0.0)
+            text = extract_text_from_pdf(uploaded_file, progress)
+            progress.empty()
             if text:
+                # Recorded only on success, so a failed file can be retried
+                st.session_state.pdf_file_id = uploaded_file.file_id
                 st.session_state.pdf_text = text
                 st.success(f"تم تحليل: {uploaded_file.name}")
                 st.session_state.messages.append({"role": "assistant", "content": "تم رفع الملف بنجاح! يمكنك الآن طلب توليد أسئلة."})
@@ -104,10 +217,19 @@ with st.sidebar:
     # Settings
     difficulty = st.selectbox("مستوى الصعوبة", ["سهل", "متوسط", "صعب"])
     q_type = st.selectbox("نوع الأسئلة", ["mix", "mcq", "truefalse"])
+    regenerate = st.checkbox("🔄 توليد جديد (تجاهل الردود المحفوظة)")
+    cache_stats = get_response_cache().get_stats()
+    st.caption(f"الردود المحفوظة: {cache_stats['hits']} إصابة / {cache_stats['misses']} إخفاق")
+    usage = get_prompt_builder().usage.summary().get("gemini")
+    if usage:
+        st.caption(
+            f"الاستهلاك: {usage['input_tokens']} رمز دخل / {usage['output_tokens']} رمز خرج "
+            f"في {usage['requests']} طلب (متوسط {usage['avg_latency']:.1f} ث)"
+        )
     
     if st.button("🗑️ مسح المحادثة"):
         st.session_state.messages = []
-        st.session_state.questions = []
+        st.session_state.questions.clear()
         st.rerun()
 
     st.markdown("---")
@@ -121,7 +243,7 @@ with st.sidebar:
 # --- Main Logic ---
 
 # Tabs
-tab1, tab2 = st.tabs(["💬 المحادثة والتوليد", "📝 عرض الأسئلة"])
+tab1, tab2, tab3 = st.tabs(["💬 المحادثة والتوليد", "📝 عرض الأسئلة", "📚 بنك الأسئلة"])
 
 with tab1:
     # Display Chat
@@ -144,63 +266,171 @@ with tab1:
             # Generate Response
             is_exam_request = any(w in prompt for w in ["ولد", "اسئلة", "اختبار", "quiz"])
             
-            full_prompt = f"""
+            try:
+                model = get_model(api_key)
+                with st.chat_message("assistant"):
+                    if is_exam_request:
+                        # Questions are generated per chunk across the whole document and
+                        # shown as soon as each :::نهاية::: block arrives
+                        total = requested_count(prompt)
+                        status = st.empty()
+                        status.markdown(f"⏳ جاري توليد {total} سؤال من كامل الملف عبر Gemini...")
+                        extracted_qs = []
+                        # Chunks are generated on worker threads, which cannot read session
+                        # state, so everything they need is bound here on the script thread
+                        pdf_text = st.session_state.pdf_text
+                        use_cache = not regenerate
+                        # Chunks are sized to the model's context token budget, not by characters
+                        prompt_builder = get_prompt_builder()
+                        for question in iter_questions(
+                            pdf_text, prompt, difficulty, q_type, total,
+                            lambda chunk_prompt: stream_cached(model, chunk_prompt, pdf_text, use_cache),
+                            chunk_size=prompt_builder.context_tokens["gemini"],
+                            measure=lambda chunk: prompt_builder.count(chunk, "gemini"),
+                        ):
+                            extracted_qs.append(question)
+                            status.markdown(
+                                f"⏳ تم توليد {len(extracted_qs)} من {total} سؤال...\n\n"
+                                f"**س{len(extracted_qs)}:** {question['question']}"
+                            )
+                        if extracted_qs:
+                            st.session_state.questions.extend(extracted_qs, difficulty, q_type)
+                            added, duplicates = get_question_bank().add_many(
+                                extracted_qs, st.session_state.pdf_hash, difficulty, q_type
+                            )
+                            bot_reply = (
+                                f"تم توليد {len(extracted_qs)} سؤال بنجاح! انتقل لتبويب 'عرض الأسئلة' لمشاهدتها.\n\n"
+                                f"📚 أُضيف {added} سؤال جديد إلى بنك الأسئلة ({duplicates} مكرر)."
+                            )
+                        else:
+                            bot_reply = "لم أتمكن من توليد أسئلة بالصيغة المطلوبة، حاول مرة أخرى."
+                        status.markdown(bot_reply)
+                    else:
+                        # Highest-scoring chunks for the question, up to the context budget
+                        index = get_document_index(st.session_state.pdf_hash, st.session_state.pdf_text)
+                        document = get_prompt_builder().select(index, prompt, "gemini")
+                        full_prompt = f"""
             Context: You are an expert educational AI.
-            Document Content: {st.session_state.pdf_text[:30000]}...
+            Document Content: {document}
             
             User Request: {prompt}
             """
-            
-            if is_exam_request:
-                full_prompt += f"""
-                \nINSTRUCTION: Generate {difficulty} questions of type {q_type}.
-                OUTPUT PATTERN STRICTLY:
-                :::سؤال::: [Question Text] || [Option A] || [Option B] || [Option C] || [Correct Answer] :::نهاية:::
-                
-                Rules:
-                1. Separator must be "||".
-                2. Language: Arabic.
-                3. Do NOT use Markdown code blocks. Just raw text.
-                """
+                        bot_reply = st.write_stream(
+                            stream_cached(model, full_prompt, st.session_state.pdf_text, not regenerate)
+                        )
 
-            try:
-                with st.spinner("جاري التواصل مع Gemini..."):
-                    model = genai.GenerativeModel('gemini-1.5-flash')
-                    response = model.generate_content(full_prompt)
-                    bot_reply = response.text
-                    
-                    # Parse Questions if found
-                    extracted_qs = parse_questions(bot_reply)
-                    if extracted_qs:
-                        st.session_state.questions.extend(extracted_qs)
-                        bot_reply = f"تم توليد {len(extracted_qs)} سؤال بنجاح! انتقل لتبويب 'عرض الأسئلة' لمشاهدتها."
-
-                    st.session_state.messages.append({"role": "assistant", "content": bot_reply})
-                    with st.chat_message("assistant"):
-                        st.markdown(bot_reply)
+                st.session_state.messages.append({"role": "assistant", "content": bot_reply})
             except Exception as e:
                 st.error(f"حدث خطأ: {e}")
 
 with tab2:
-    if not st.session_state.questions:
+    store = st.session_state.questions
+    if not store:
         st.info("لا توجد أسئلة مولدة بعد. اذهب للشات واطلب: 'ولد لي 5 أسئلة'.")
     else:
         # Header for Print
         st.markdown("### 📄 ورقة الأسئلة")
         
+        # Printable exam forms and answer key, rendered in memory
+        if st.toggle("🖨️ تجهيز ملفات الطباعة (PDF)"):
+            exam_title = st.text_input("عنوان الاختبار", value="اختبار")
+            form_count = st.selectbox("عدد النماذج", [1, 2, 3], index=2)
+            forms = ("A", "B", "C")[:form_count] if form_count > 1 else ()
+            files = export_exam(store.content_hash(), exam_title, forms, store.as_dicts())
+            labels = {"exam.pdf": "📄 الامتحان", "answer_key.pdf": "🔑 نموذج الإجابة"}
+            for col, (name, data) in zip(st.columns(len(files)), files.items()):
+                label = labels.get(name, f"📄 نموذج {name[5:-4]}")
+                col.download_button(label, data=data, file_name=name, mime="application/pdf", key=f"dl_{name}")
+        
+        # Search & Filters
+        col_search, col_difficulty, col_type = st.columns([2, 1, 1])
+        query = col_search.text_input("🔍 بحث في الأسئلة")
+        difficulty_filter = col_difficulty.selectbox("الصعوبة", ["الكل", "سهل", "متوسط", "صعب"])
+        type_filter = col_type.selectbox("النوع", ["الكل", "mix", "mcq", "truefalse"])
+        results = store.filter(
+            query,
+            None if difficulty_filter == "الكل" else difficulty_filter,
+            None if type_filter == "الكل" else type_filter
+        )
+        
+        # Only the current page is rendered, so reruns cost the same for any bank size
+        col_size, col_page = st.columns(2)
+        page_size = col_size.selectbox("أسئلة في الصفحة", [10, 25, 50], index=1)
+        pages = max(1, -(-len(results) // page_size))
+        if st.session_state.get("bank_page", 1) > pages:
+            st.session_state.bank_page = pages
+        page = col_page.number_input(f"الصفحة (من {pages})", min_value=1, max_value=pages, key="bank_page")
+        page_records, _ = paginate(results, page, page_size)
+        st.caption(f"{len(results)} سؤال مطابق من أصل {len(store)}")
+        
+        # Bulk Actions (checkbox keys use stable question IDs)
+        col_select, col_delete = st.columns(2)
+        if col_select.button("☑️ تحديد أسئلة الصفحة"):
+            for record in page_records:
+                st.session_state[f"sel_{record.id}"] = True
+        selected = [record.id for record in store if st.session_state.get(f"sel_{record.id}")]
+        if col_delete.button(f"🗑️ حذف المحدد ({len(selected)})", disabled=not selected):
+            store.remove(selected)
+            for question_id in selected:
+                st.session_state.pop(f"sel_{question_id}", None)
+            st.rerun()
+        
+        if not results:
+            st.info("لا توجد أسئلة مطابقة للبحث.")
+        
         # Questions Loop
-        for i, q in enumerate(st.session_state.questions):
-            st.markdown(f"""
+        for number, q in enumerate(page_records, start=(page - 1) * page_size + 1):
+            col_card, col_check = st.columns([12, 1])
+            col_check.checkbox("تحديد", key=f"sel_{q.id}", label_visibility="collapsed")
+            col_card.markdown(f"""
             <div class="question-card">
-                <div style="font-weight:bold; margin-bottom:10px;">س{i+1}: {q['question']}</div>
-                {''.join([f'<div style="margin:5px 0;">⚪ {opt}</div>' for opt in q['options']])}
-                <div class="correct-answer">الإجابة الصحيحة: {q['answer']}</div>
+                <div style="font-weight:bold; margin-bottom:10px;">س{number}: {q.question}</div>
+                {''.join([f'<div style="margin:5px 0;">⚪ {opt}</div>' for opt in q.options])}
+                <div class="correct-answer">الإجابة الصحيحة: {q.answer}</div>
             </div>
             """, unsafe_allow_html=True)
             
             # Delete Button
-            if st.button(f"حذف السؤال {i+1}", key=f"del_{i}"):
-                st.session_state.questions.pop(i)
+            if col_card.button(f"حذف السؤال {number}", key=f"del_{q.id}"):
+                store.remove([q.id])
+                st.session_state.pop(f"sel_{q.id}", None)
                 st.rerun()
 
-
+with tab3:
+    # Stored questions from earlier sessions, searchable without calling Gemini again
+    bank = get_question_bank()
+    col_search, col_difficulty, col_type = st.columns([2, 1, 1])
+    bank_query = col_search.text_input("🔍 بحث في البنك")
+    bank_difficulty = col_difficulty.selectbox("الصعوبة", ["الكل", "سهل", "متوسط", "صعب"], key="bank_difficulty")
+    bank_type = col_type.selectbox("النوع", ["الكل", "mix", "mcq", "truefalse"], key="bank_type")
+    this_document = st.checkbox("من الملف الحالي فقط", disabled=not st.session_state.pdf_hash)
+    filters = {
+        "query": bank_query,
+        "doc_hash": st.session_state.pdf_hash if this_document else None,
+        "difficulty": None if bank_difficulty == "الكل" else bank_difficulty,
+        "q_type": None if bank_type == "الكل" else bank_type,
+    }
+    
+    total = bank.count(**filters)
+    bank_pages = max(1, -(-total // 25))
+    if st.session_state.get("db_page", 1) > bank_pages:
+        st.session_state.db_page = bank_pages
+    bank_page = st.number_input(f"الصفحة (من {bank_pages})", min_value=1, max_value=bank_pages, key="db_page")
+    results = bank.search(**filters, limit=25, offset=(bank_page - 1) * 25)
+    st.caption(f"{total} سؤال في البنك مطابق للبحث")
+    
+    for q in results:
+        st.checkbox(f"{q['question']}  —  ✅ {q['answer']}", key=f"bank_{q['id']}")
+    
+    chosen = [q for q in results if st.session_state.get(f"bank_{q['id']}")]
+    col_add, col_remove = st.columns(2)
+    if col_add.button(f"➕ إضافة المحدد إلى ورقة الأسئلة ({len(chosen)})", disabled=not chosen):
+        for q in chosen:
+            st.session_state.questions.add(q, q["difficulty"], q["q_type"])
+            st.session_state.pop(f"bank_{q['id']}", None)
+        st.rerun()
+    if col_remove.button(f"🗑️ حذف المحدد من البنك ({len(chosen)})", disabled=not chosen):
+        bank.delete(q["id"] for q in chosen)
+        for q in chosen:
+            st.session_state.pop(f"bank_{q['id']}", None)
+        st.rerun()
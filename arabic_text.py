@@ -0,0 +1,145 @@
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# ==================== توحيد النص العربي ====================
+TASHKEEL = re.compile(r"[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED]")
+TATWEEL = "\u0640"
+ALEF_FORMS = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه", "ؤ": "و", "ئ": "ي"})
+TOKEN = re.compile(r"\w+")
+
+PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال")
+
+STOPWORDS = {
+    "من", "في", "علي", "الي", "عن", "ما", "ماذا", "هل", "هو", "هي", "التي", "الذي",
+    "ذلك", "هذا", "هذه", "كيف", "لماذا", "متي", "اين", "مع", "او", "ثم", "كل", "لا",
+    "ان", "كان", "قد", "به", "بها", "له", "لها", "the", "a", "an", "of", "to", "in",
+    "is", "and", "or", "what", "how", "why",
+}
+
+
+def normalize_arabic(text: str) -> str:
+    """حذف التشكيل والتطويل وتوحيد أشكال الألف والياء والتاء المربوطة"""
+    text = TASHKEEL.sub("", text).replace(TATWEEL, "")
+    return text.translate(ALEF_FORMS).lower()
+
+
+def strip_prefix(token: str) -> str:
+    """تجذيع خفيف: حذف أداة التعريف وما يسبقها من حروف الجر والعطف"""
+    for prefix in PREFIXES:
+        if token.startswith(prefix) and len(token) - len(prefix) >= 2:
+            return token[len(prefix):]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """تقسيم النص إلى كلمات موحدة صالحة للبحث"""
+    tokens = (strip_prefix(t) for t in TOKEN.findall(normalize_arabic(text)) if t not in STOPWORDS)
+    return [t for t in tokens if len(t) > 1]
+
+
+# ==================== تنظيف النص قبل الإرسال للنماذج ====================
+NORMALIZATION_CONFIG = {
+    "EDGE_LINES": 2,  # عدد الأسطر في أعلى وأسفل كل صفحة المرشحة كترويسة/تذييل
+    "MAX_EDGE_CHARS": 80,  # الترويسة سطر قصير، والأسطر الأطول تُعد محتوى
+    "REPEAT_RATIO": 0.5,  # نسبة الصفحات التي يتكرر فيها السطر ليُعد ترويسة
+    "MIN_DUPLICATE_CHARS": 40,  # أقل طول للفقرة المكررة التي تُحذف
+    # توحيد الألف والياء يغير الإملاء في الأسئلة المولدة، لذا هو اختياري
+    "UNIFY_LETTERS": False,
+}
+
+# رقم صفحة مستقل: سطر كامل ("12"، "- 12 -"، "صفحة 12 من 30") أو رقم في طرف السطر بعد فاصل
+PAGE_NUMBER_LINE = re.compile(
+    r"^\W*(?:(?:page|صفحة|ص)\.?\s*)?[\d٠-٩]+(?:\s*(?:/|of|من)\s*[\d٠-٩]+)?\W*$", re.IGNORECASE
+)
+PAGE_NUMBER_EDGE = re.compile(r"^[\d٠-٩]+\s*[|\-–•]\s*|\s*[|\-–•]\s*[\d٠-٩]+$")
+HYPHENATED = re.compile(r"(\w)-\n(\w)")
+SPACES = re.compile(r"[ \t ]+")
+BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def estimate_tokens(text: str) -> int:
+    """تقدير تقريبي لعدد الرموز: كل كلمة أو علامة ترقيم رمز واحد على الأقل"""
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def _edge_key(line: str) -> str:
+    # أرقام الصفحات تختلف من صفحة لأخرى؛ باقي الأرقام جزء من المحتوى فلا تُخفى
+    line = line.strip()
+    if len(line) > NORMALIZATION_CONFIG["MAX_EDGE_CHARS"]:
+        return ""
+    if PAGE_NUMBER_LINE.match(line):
+        return "#"
+    return PAGE_NUMBER_EDGE.sub(" # ", line).strip()
+
+
+def detect_repeated_edges(pages_lines: List[List[str]]) -> set:
+    """الأسطر المتكررة في أعلى أو أسفل أغلب الصفحات (ترويسة/تذييل)"""
+    if len(pages_lines) < 3:
+        return set()
+    edge = NORMALIZATION_CONFIG["EDGE_LINES"]
+    counts: Counter = Counter()
+    for lines in pages_lines:
+        content = [line for line in lines if line.strip()]
+        counts.update({_edge_key(line) for line in content[:edge] + content[-edge:]})
+    threshold = max(3, int(len(pages_lines) * NORMALIZATION_CONFIG["REPEAT_RATIO"]))
+    return {key for key, count in counts.items() if count >= threshold and key}
+
+
+def normalize_pages(pages: List[str], unify_letters: Optional[bool] = None) -> Tuple[List[str], Dict]:
+    """تنظيف صفحات المستند دفعة واحدة مع تقرير بما تم توفيره
+
+    يحذف الترويسات والتذييلات المتكررة، ويصل الكلمات المقسومة بشرطة، ويحذف التشكيل
+    والتطويل، ويضغط المسافات، ويحذف الفقرات المكررة.
+    """
+    if unify_letters is None:
+        unify_letters = NORMALIZATION_CONFIG["UNIFY_LETTERS"]
+    before = "".join(pages)
+
+    pages_lines = [page.split("\n") for page in pages]
+    repeated = detect_repeated_edges(pages_lines)
+    edge = NORMALIZATION_CONFIG["EDGE_LINES"]
+
+    seen_paragraphs = set()
+    cleaned = []
+    for lines in pages_lines:
+        content_positions = [i for i, line in enumerate(lines) if line.strip()]
+        edge_positions = set(content_positions[:edge] + content_positions[-edge:])
+        dropped = {i for i in edge_positions if _edge_key(lines[i]) in repeated}
+        # صفحة قصيرة (شريحة مثلاً) كل أسطرها في الأطراف: لا تُفرغ بالكامل
+        if len(dropped) == len(content_positions):
+            dropped = set()
+        kept = [line for i, line in enumerate(lines) if i not in dropped]
+
+        text = HYPHENATED.sub(r"\1\2", "\n".join(kept))
+        text = TASHKEEL.sub("", text).replace(TATWEEL, "")
+        if unify_letters:
+            text = text.translate(ALEF_FORMS)
+        text = "\n".join(SPACES.sub(" ", line).strip() for line in text.split("\n"))
+        text = BLANK_LINES.sub("\n\n", text).strip()
+
+        paragraphs = []
+        for paragraph in text.split("\n\n"):
+            key = normalize_arabic(SPACES.sub(" ", paragraph.replace("\n", " ")))
+            if len(key) >= NORMALIZATION_CONFIG["MIN_DUPLICATE_CHARS"]:
+                if key in seen_paragraphs:
+                    continue
+                seen_paragraphs.add(key)
+            paragraphs.append(paragraph)
+        cleaned.append("\n\n".join(paragraphs))
+
+    after = "".join(cleaned)
+    bytes_before = len(before.encode("utf-8"))
+    bytes_after = len(after.encode("utf-8"))
+    tokens_before = estimate_tokens(before)
+    tokens_after = estimate_tokens(after)
+    report = {
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "bytes_saved": bytes_before - bytes_after,
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_before - tokens_after,
+        "repeated_lines": len(repeated),
+    }
+    return cleaned, report
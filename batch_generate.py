@@ -0,0 +1,272 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import google.generativeai as genai
+
+from arabic_text import estimate_tokens, normalize_pages
+from llm_cache import ResponseCache
+from pdf_cache import PDFCache, document_hash
+from pdf_tools import iter_pages, open_pdf, select_pages
+from question_bank import QuestionBank
+from question_generator import GENERATION_CONFIG, generate_questions
+
+logger = logging.getLogger(__name__)
+
+# ==================== توليد الأسئلة دفعة واحدة لمجلد ملفات ====================
+# python batch_generate.py handouts/ --out bank.jsonl --questions 30
+# يمكن إيقافه في أي وقت؛ التشغيل بنفس الأوامر يكمل من آخر ملف لم ينته.
+
+BATCH_CONFIG = {
+    "MODEL": "gemini-1.5-flash",
+    "MAX_PDF_PAGES": 300,  # نفس حد تطبيق Streamlit حتى تُشارك ذاكرة النصوص
+    "PARALLEL_DOCS": 2,  # عدد الملفات التي تُولد أسئلتها في نفس الوقت
+    "MAX_REQUESTS": 8,  # أقصى عدد طلبات متزامنة للنموذج عبر كل الملفات
+    "REQUEST": "ولد أسئلة شاملة تغطي كل المحتوى",
+}
+
+CSV_FIELDS = ["source", "doc_hash", "question", "options", "answer", "difficulty", "q_type"]
+
+
+def extract_document(path: str, max_pages: int) -> Tuple[str, str, int]:
+    """استخراج نص الملف وتنظيفه داخل عامل مستقل؛ يُرجع (البصمة، النص، عدد الصفحات)"""
+    with open(path, "rb") as f:
+        doc_hash = document_hash(f.read())
+    cache = PDFCache()
+    cache_key = PDFCache.make_key(doc_hash, "clean_text", max_pages=max_pages)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return doc_hash, cached, 0
+
+    doc = open_pdf(path)
+    try:
+        page_numbers = select_pages(len(doc), max_pages, sample=True)
+        pages, _ = normalize_pages(list(iter_pages(doc, page_numbers)))
+    finally:
+        doc.close()
+    text = "\n".join(pages)
+    cache.set(cache_key, text)
+    return doc_hash, text, len(page_numbers)
+
+
+class Checkpoint:
+    """الملفات المكتملة، تُحفظ بعد كل ملف بكتابة ذرية حتى لا تتلف عند المقاطعة"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.done = json.load(f).get("done", {})
+
+    def mark(self, doc_hash: str, source: str, questions: int):
+        self.done[doc_hash] = {"source": source, "questions": questions, "finished": time.time()}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"done": self.done}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class QuestionWriter:
+    """إلحاق الأسئلة بملف JSONL أو CSV فور انتهاء كل ملف"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.format = "csv" if path.lower().endswith(".csv") else "jsonl"
+
+    def prune(self, keep: Set[str]):
+        """حذف أسطر الملفات غير المسجلة في نقاط الاستكمال (انقطاع بين الكتابة والتسجيل)
+
+        تُعاد كتابة الملف كاملاً مرة واحدة عند الاستكمال، فلا تتكرر أسئلة ملف أُعيد توليده.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8", newline="") as f:
+            if self.format == "jsonl":
+                lines = f.read().splitlines(keepends=True)
+                kept = [line for line in lines if _row_doc_hash(line) in keep]
+                dropped = len(lines) - len(kept)
+            else:
+                rows = list(csv.DictReader(f))
+                kept = [row for row in rows if row.get("doc_hash") in keep]
+                dropped = len(rows) - len(kept)
+        if not dropped:
+            return
+        logger.warning(f"{self.path}: dropping {dropped} rows of unfinished files before resuming")
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            if self.format == "jsonl":
+                f.writelines(line if line.endswith("\n") else line + "\n" for line in kept)
+            else:
+                writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+                writer.writeheader()
+                writer.writerows(kept)
+        os.replace(tmp_path, self.path)
+
+    def write(self, rows: List[Dict]):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a", encoding="utf-8", newline="") as f:
+            if self.format == "jsonl":
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            else:
+                writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+                if new_file:
+                    writer.writeheader()
+                writer.writerows(dict(row, options=" | ".join(row["options"])) for row in rows)
+
+
+def _row_doc_hash(line: str) -> Optional[str]:
+    try:
+        return json.loads(line).get("doc_hash")
+    except ValueError:
+        return None  # سطر مقطوع أثناء الكتابة
+
+
+class BatchStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.docs = 0
+        self.questions = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+
+    def add_tokens(self, input_tokens: int, output_tokens: int):
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        minutes = elapsed / 60
+        return (
+            f"{self.docs} docs, {self.questions} questions in {elapsed:.1f}s | "
+            f"{self.docs / minutes:.1f} docs/min, {self.questions / minutes:.1f} questions/min, "
+            f"{(self.input_tokens + self.output_tokens) / elapsed:.0f} tokens/sec "
+            f"({self.input_tokens} in / {self.output_tokens} out)"
+        )
+
+
+def make_generate(model, cache: ResponseCache, document: str, use_cache: bool,
+                  requests: threading.Semaphore, stats: BatchStats):
+    """دالة توليد متزامنة لـ generate_questions، مع ذاكرة الردود وحد الطلبات المتزامنة"""
+    def generate(prompt: str) -> List[str]:
+        cache_key = ResponseCache.make_key("gemini", model.model_name, prompt, document)
+        if use_cache and (cached := cache.get(cache_key)) is not None:
+            return [cached]
+        with requests:
+            response = model.generate_content(prompt)
+        usage = getattr(response, "usage_metadata", None)
+        stats.add_tokens(
+            getattr(usage, "prompt_token_count", 0) or estimate_tokens(prompt),
+            getattr(usage, "candidates_token_count", 0) or estimate_tokens(response.text),
+        )
+        cache.set(cache_key, response.text)
+        return [response.text]
+    return generate
+
+
+async def run_batch(args: argparse.Namespace) -> BatchStats:
+    sources = sorted(Path(args.input_dir).rglob("*.pdf"))
+    checkpoint = Checkpoint(args.checkpoint or f"{args.out}.checkpoint.json")
+    writer = QuestionWriter(args.out)
+    # الأسئلة تُكتب قبل تسجيل الملف؛ عند الاستكمال يُحذف ما كُتب لملف لم يُسجل ثم يُولد من جديد
+    if os.path.exists(checkpoint.path):
+        writer.prune(set(checkpoint.done))
+    stats = BatchStats()
+    response_cache = ResponseCache()
+    model = genai.GenerativeModel(args.model)
+    bank = QuestionBank() if args.bank else None
+    requests = threading.Semaphore(args.max_requests)
+    parallel_docs = asyncio.Semaphore(args.parallel_docs)
+    loop = asyncio.get_running_loop()
+
+    done_sources = {entry["source"] for entry in checkpoint.done.values()}
+    pending = [path for path in sources if str(path) not in done_sources]
+    print(f"{len(sources)} PDFs found, {len(sources) - len(pending)} already done, {len(pending)} to process")
+
+    async def process(pool: ProcessPoolExecutor, path: Path):
+        # الحد يشمل الاستخراج: لا يبقى في الذاكرة إلا نصوص الملفات قيد المعالجة
+        async with parallel_docs:
+            try:
+                doc_hash, text, pages = await loop.run_in_executor(pool, extract_document, str(path), args.max_pages)
+            except Exception as e:
+                logger.error(f"{path}: extraction failed: {e}")
+                return
+            if doc_hash in checkpoint.done:
+                checkpoint.mark(doc_hash, str(path), checkpoint.done[doc_hash]["questions"])
+                return
+            if not text.strip():
+                logger.warning(f"{path}: no extractable text (scanned?), skipped")
+                return
+
+            generate = make_generate(model, response_cache, text, not args.regenerate, requests, stats)
+            questions = await asyncio.to_thread(
+                generate_questions, text, args.request, args.difficulty, args.q_type,
+                args.questions, generate, args.max_requests
+            )
+
+        if not questions:
+            logger.warning(f"{path}: no questions generated, will retry on next run")
+            return
+        writer.write([
+            {"source": str(path), "doc_hash": doc_hash, **question,
+             "difficulty": args.difficulty, "q_type": args.q_type}
+            for question in questions
+        ])
+        if bank is not None:
+            bank.add_many(questions, doc_hash, args.difficulty, args.q_type)
+        checkpoint.mark(doc_hash, str(path), len(questions))
+        stats.docs += 1
+        stats.questions += len(questions)
+        print(f"✓ {path.name}: {len(questions)} questions{f' from {pages} pages' if pages else ''} | {stats.summary()}")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        await asyncio.gather(*(process(pool, path) for path in pending))
+    return stats
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="توليد بنك أسئلة لكل ملفات PDF في مجلد")
+    parser.add_argument("input_dir", help="مجلد ملفات PDF (يشمل المجلدات الفرعية)")
+    parser.add_argument("--out", default="questions.jsonl", help="ملف الناتج: ‎.jsonl أو ‎.csv")
+    parser.add_argument("--checkpoint", help="ملف نقاط الاستكمال (الافتراضي: <out>.checkpoint.json)")
+    parser.add_argument("--questions", type=int, default=GENERATION_CONFIG["DEFAULT_QUESTIONS"],
+                        help="عدد الأسئلة لكل ملف")
+    parser.add_argument("--difficulty", default="متوسط", choices=["سهل", "متوسط", "صعب"])
+    parser.add_argument("--q-type", default="mix", choices=["mix", "mcq", "truefalse"])
+    parser.add_argument("--request", default=BATCH_CONFIG["REQUEST"])
+    parser.add_argument("--model", default=BATCH_CONFIG["MODEL"])
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="عمليات استخراج النص")
+    parser.add_argument("--parallel-docs", type=int, default=BATCH_CONFIG["PARALLEL_DOCS"])
+    parser.add_argument("--max-requests", type=int, default=BATCH_CONFIG["MAX_REQUESTS"])
+    parser.add_argument("--max-pages", type=int, default=BATCH_CONFIG["MAX_PDF_PAGES"])
+    parser.add_argument("--bank", action="store_true", help="حفظ الأسئلة في بنك الأسئلة أيضاً")
+    parser.add_argument("--regenerate", action="store_true", help="تجاهل الردود المحفوظة")
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("Gemini API key is required (--api-key or GEMINI_API_KEY)")
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    genai.configure(api_key=args.api_key)
+
+    try:
+        stats = asyncio.run(run_batch(args))
+    except KeyboardInterrupt:
+        print("Interrupted; run the same command again to resume.")
+        return
+    print(f"Done: {stats.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import hashlib
+import html
+import json
+import random
+from typing import Dict, List, Optional, Sequence
+
+from pdf_render import render_html
+
+# ==================== تصدير ورقة الامتحان ====================
+OPTION_LETTERS = "أبجدهوزحطي"
+
+EXAM_CSS = """
+h1 { text-align: center; margin-bottom: 4pt; }
+.info { color: #555; font-size: 11pt; margin-bottom: 14pt; }
+.question { font-weight: bold; margin: 10pt 0 3pt 0; }
+.options { margin: 0 0 4pt 0; }
+.key { font-size: 13pt; line-height: 1.9; }
+"""
+
+
+def question_set_hash(questions: List[Dict]) -> str:
+    """بصمة مجموعة الأسئلة بترتيبها، تُستخدم مفتاحاً لذاكرة الملفات المصدرة"""
+    raw = json.dumps(questions, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def answer_index(question: Dict) -> Optional[int]:
+    """موضع الإجابة الصحيحة بين الخيارات (بالنص أو بحرف الخيار)"""
+    answer = str(question.get("answer", "")).strip()
+    options = [str(option).strip() for option in question.get("options", [])]
+    if answer in options:
+        return options.index(answer)
+    # حرف الخيار ("ب" أو "ب)" أو "(ب)") قبل المطابقة الجزئية، فالحرف يظهر داخل نصوص الخيارات
+    letter = answer.strip("().: ")
+    if len(letter) == 1 and letter in OPTION_LETTERS[:len(options)]:
+        return OPTION_LETTERS.index(letter)
+    for i, option in enumerate(options):
+        if answer and option and (answer in option or option in answer):
+            return i
+    return None
+
+
+def shuffle_form(questions: List[Dict], form: str, set_hash: str) -> List[Dict]:
+    """نموذج بترتيب مختلف للأسئلة والخيارات، ثابت لنفس المجموعة ونفس اسم النموذج"""
+    rng = random.Random(f"{set_hash}:{form}")
+    shuffled = []
+    for question in rng.sample(questions, len(questions)):
+        options = list(question.get("options", []))
+        correct = answer_index(question)
+        order = list(range(len(options)))
+        # خيارات صح/خطأ تبقى بترتيبها المعتاد
+        if len(options) > 2:
+            rng.shuffle(order)
+        shuffled.append({
+            "question": question["question"],
+            "options": [options[i] for i in order],
+            "answer": question.get("answer", ""),
+            "answer_index": order.index(correct) if correct is not None else None,
+        })
+    return shuffled
+
+
+def _answer_label(question: Dict) -> str:
+    index = question.get("answer_index")
+    if index is None:
+        return html.escape(str(question["answer"]))
+    return OPTION_LETTERS[index]
+
+
+def exam_html(questions: List[Dict], title: str, form: Optional[str] = None) -> str:
+    parts = [f"<h1>{html.escape(title)}</h1>"]
+    info = f"نموذج ({form}) — " if form else ""
+    parts.append(f"<p class='info'>{info}عدد الأسئلة: {len(questions)}<br>الاسم: ................................ الفصل: ..........</p>")
+    for number, question in enumerate(questions, 1):
+        parts.append(f"<p class='question'>{number}. {html.escape(question['question'])}</p>")
+        options = "<br>".join(
+            f"{OPTION_LETTERS[i]}) {html.escape(str(option))}"
+            for i, option in enumerate(question["options"][:len(OPTION_LETTERS)])
+        )
+        if options:
+            parts.append(f"<p class='options'>{options}</p>")
+    return "\n".join(parts)
+
+
+def answer_key_html(forms: Dict[str, List[Dict]], title: str) -> str:
+    parts = [f"<h1>{html.escape(title)} — نموذج الإجابة</h1>"]
+    for form, questions in forms.items():
+        if form:
+            parts.append(f"<h2>نموذج ({form})</h2>")
+        answers = " &nbsp;&nbsp; ".join(
+            f"{number}. {_answer_label(question)}" for number, question in enumerate(questions, 1)
+        )
+        parts.append(f"<p class='key'>{answers}</p>")
+    return "\n".join(parts)
+
+
+def build_exam_files(questions: List[Dict], title: str = "اختبار",
+                     forms: Sequence[str] = ("A", "B", "C")) -> Dict[str, bytes]:
+    """ملفات PDF للامتحان في الذاكرة: نموذج لكل اسم في forms ونموذج إجابة يجمعها
+
+    بدون forms يُصدر الامتحان بترتيبه الأصلي.
+    """
+    set_hash = question_set_hash(questions)
+    if forms:
+        versions = {form: shuffle_form(questions, form, set_hash) for form in forms}
+    else:
+        versions = {"": [dict(q, answer_index=answer_index(q)) for q in questions]}
+
+    files = {}
+    for form, form_questions in versions.items():
+        name = f"exam_{form}.pdf" if form else "exam.pdf"
+        files[name] = render_html(exam_html(form_questions, title, form or None), EXAM_CSS)
+    files["answer_key.pdf"] = render_html(answer_key_html(versions, title), EXAM_CSS)
+    return files
+
+
+if __name__ == "__main__":
+    # قياس سريع: زمن تصدير مجموعة كبيرة بثلاثة نماذج
+    import time
+
+    sample = [
+        {
+            "question": f"ما الوظيفة الأساسية للعضية رقم {i} في الخلية النباتية؟",
+            "options": ["إنتاج الطاقة", "تخزين المواد", "البناء الضوئي", "نقل البروتينات"],
+            "answer": "البناء الضوئي",
+        }
+        for i in range(300)
+    ]
+    started = time.perf_counter()
+    files = build_exam_files(sample, "اختبار الأحياء")
+    elapsed = time.perf_counter() - started
+    sizes = ", ".join(f"{name} {len(data) // 1024} KB" for name, data in files.items())
+    print(f"{len(sample)} questions x 3 forms + key in {elapsed:.2f}s ({sizes})")
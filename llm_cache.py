@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# ==================== إعدادات ذاكرة الردود ====================
+RESPONSE_CACHE_CONFIG = {
+    "DB_PATH": os.environ.get(
+        "LLM_CACHE_PATH", os.path.join(tempfile.gettempdir(), "qbank_llm_cache.sqlite3")
+    ),
+    "TTL_SECONDS": 7 * 24 * 3600,  # أسبوع
+    "MAX_BYTES": 200 * 1024 * 1024,  # 200MB
+}
+
+
+class ResponseCache:
+    """ذاكرة دائمة (SQLite) لردود النماذج مع مدة صلاحية وحد للحجم"""
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        ttl_seconds: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.db_path = db_path or RESPONSE_CACHE_CONFIG["DB_PATH"]
+        self.ttl_seconds = ttl_seconds or RESPONSE_CACHE_CONFIG["TTL_SECONDS"]
+        self.max_bytes = max_bytes or RESPONSE_CACHE_CONFIG["MAX_BYTES"]
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(provider: str, model: str, prompt: str, document: str = "") -> str:
+        """مفتاح يجمع المزود والنموذج والطلب وبصمة المستند"""
+        doc_hash = hashlib.sha256(document.encode("utf-8")).hexdigest() if document else ""
+        raw = "\x1f".join([provider, model, doc_hash, prompt])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.stats["hits"] += 1
+            return row[0]
+
+    def set(self, key: str, response: str):
+        if not response:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, size, created, accessed) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, response, len(response.encode("utf-8")), now, now),
+                )
+                self._evict(now)
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Response cache write error: {e}")
+
+    def _evict(self, now: float):
+        """حذف المنتهية صلاحيتها ثم الأقدم استخداماً حتى يعود الحجم تحت الحد"""
+        self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT 50"
+            ).fetchall()
+            if not rows:
+                break
+            self._conn.executemany("DELETE FROM responses WHERE key = ?", [(r[0],) for r in rows])
+            total -= sum(r[1] for r in rows)
+
+    def get_stats(self) -> Dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats, hit_ratio=self.stats["hits"] / lookups if lookups else 0.0)
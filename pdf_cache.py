@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# ==================== إعدادات الذاكرة المؤقتة ====================
+CACHE_CONFIG = {
+    "CACHE_DIR": os.environ.get(
+        "PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "qbank_pdf_cache")
+    ),
+    "MAX_MEMORY_ITEMS": 64,  # عدد العناصر في الذاكرة
+    "MAX_DISK_BYTES": 500 * 1024 * 1024,  # 500MB على القرص
+    "EVICT_TO_RATIO": 0.8,  # الإخلاء حتى هذه النسبة من الحد حتى لا يتكرر المسح مع كل كتابة
+}
+
+
+def document_hash(pdf_bytes: bytes) -> str:
+    """بصمة محتوى ملف PDF"""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+class PDFCache:
+    """ذاكرة مؤقتة بطبقتين (ذاكرة LRU + قرص) لنتائج معالجة PDF"""
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_memory_items: Optional[int] = None,
+        max_disk_bytes: Optional[int] = None,
+    ):
+        self.cache_dir = cache_dir or CACHE_CONFIG["CACHE_DIR"]
+        self.max_memory_items = max_memory_items or CACHE_CONFIG["MAX_MEMORY_ITEMS"]
+        self.max_disk_bytes = max_disk_bytes or CACHE_CONFIG["MAX_DISK_BYTES"]
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._disk_bytes: Optional[int] = None  # يُحسب بمسح واحد ثم يُحدث مع كل كتابة
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(doc_hash: str, kind: str, **params) -> str:
+        """مفتاح يجمع بصمة الملف ونوع النتيجة ومعاملات الاستخراج"""
+        suffix = ",".join(f"{k}={params[k]}" for k in sorted(params))
+        return hashlib.sha256(f"{doc_hash}:{kind}:{suffix}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)  # تحديث وقت الاستخدام لسياسة الإخلاء
+        except (OSError, ValueError):
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+
+        with self._lock:
+            self.stats["disk_hits"] += 1
+            self._remember(key, value)
+        return value
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._remember(key, value)
+
+        try:
+            # قد يُحذف المجلد المؤقت أثناء التشغيل
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False, default=_json_default)
+            path = self._path(key)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+            self._track_disk(size - replaced)
+        except (OSError, TypeError) as e:
+            logger.error(f"PDF cache write error: {e}")
+
+    def _remember(self, key: str, value: Any):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _track_disk(self, delta: int):
+        """تحديث الحجم على القرص، والمسح للإخلاء فقط عند تجاوز الحد"""
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk()[1]
+            else:
+                self._disk_bytes += delta
+            over_limit = self._disk_bytes > self.max_disk_bytes
+        if over_limit:
+            self._evict_disk()
+
+    def _scan_disk(self):
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        return entries, total
+
+    def _evict_disk(self):
+        """حذف الأقدم استخداماً حتى يعود الحجم تحت الحد
+
+        يُعاد حساب الحجم من القرص هنا لأن عمليات أخرى قد تكتب في نفس المجلد.
+        """
+        entries, total = self._scan_disk()
+        if total > self.max_disk_bytes:
+            target = self.max_disk_bytes * CACHE_CONFIG["EVICT_TO_RATIO"]
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= target:
+                    break
+        with self._lock:
+            self._disk_bytes = total
+
+    def get_stats(self) -> Dict:
+        return dict(self.stats, memory_items=len(self._memory))
+
+
+def _json_default(value: Any):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
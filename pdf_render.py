@@ -0,0 +1,122 @@
+import html
+import io
+import re
+from typing import Optional
+
+import fitz  # PyMuPDF
+
+# ==================== إنشاء PDF داخل العملية ====================
+# محرك MuPDF (fitz.Story) يشكل الحروف العربية ويرتب الأسطر من اليمين لليسار
+# بخط Noto Naskh Arabic المدمج، دون ملفات مؤقتة أو برامج خارجية.
+
+RENDER_CONFIG = {
+    "PAPER": "a4",
+    "MARGIN": 50,  # نقطة من كل جانب
+    "SUBSET_FONTS": True,  # تضمين الحروف المستخدمة فقط من الخطوط (يصغر الملف عدة مرات)
+}
+
+BASE_CSS = """
+body { font-family: sans-serif; font-size: 12pt; line-height: 1.6; direction: rtl; }
+h1 { color: #2c3e50; font-size: 20pt; margin-bottom: 12pt; }
+h2 { color: #2c3e50; font-size: 16pt; }
+h3 { font-size: 13pt; }
+p { margin: 0 0 8pt 0; }
+"""
+
+BOLD = re.compile(r"\*\*(.+?)\*\*")
+
+
+def text_to_html(text: str, title: Optional[str] = None) -> str:
+    """تحويل رد النموذج (فقرات وعناوين وقوائم Markdown بسيطة) إلى HTML آمن"""
+    parts = [f"<h1>{html.escape(title)}</h1>"] if title else []
+    for block in re.split(r"\n\s*\n", text.strip()):
+        lines = []
+        for line in block.strip().split("\n"):
+            line = line.strip()
+            heading = re.match(r"(#{1,3})\s+(.*)", line)
+            if heading:
+                level = len(heading.group(1)) + 1
+                parts.append(f"<h{level}>{html.escape(heading.group(2))}</h{level}>")
+                continue
+            line = BOLD.sub(r"<b>\1</b>", html.escape(line))
+            # علامات قوائم HTML تظهر في الجهة الخطأ مع الاتجاه من اليمين، فتُكتب نصاً
+            if line[:2] in ("- ", "* ", "• "):
+                line = "• " + line[2:]
+            lines.append(line)
+        if lines:
+            parts.append(f"<p>{'<br>'.join(lines)}</p>")
+    return "\n".join(parts)
+
+
+def render_html(body: str, css: str = "") -> bytes:
+    """تحويل HTML إلى ملف PDF في الذاكرة وإرجاع محتواه"""
+    story = fitz.Story(html=body, user_css=BASE_CSS + css)
+    buffer = io.BytesIO()
+    writer = fitz.DocumentWriter(buffer)
+    mediabox = fitz.paper_rect(RENDER_CONFIG["PAPER"])
+    margin = RENDER_CONFIG["MARGIN"]
+    where = mediabox + (margin, margin, -margin, -margin)
+
+    more = True
+    while more:
+        device = writer.begin_page(mediabox)
+        more, _ = story.place(where)
+        story.draw(device)
+        writer.end_page()
+    writer.close()
+
+    if not RENDER_CONFIG["SUBSET_FONTS"]:
+        return buffer.getvalue()
+    doc = fitz.open(stream=buffer.getbuffer(), filetype="pdf")
+    try:
+        doc.subset_fonts()
+        return doc.tobytes(garbage=3, deflate=True)
+    finally:
+        doc.close()
+
+
+def render_text(text: str, title: Optional[str] = None) -> bytes:
+    return render_html(text_to_html(text, title))
+
+
+if __name__ == "__main__":
+    # مقارنة زمن وذاكرة إنشاء مستند واحد: داخل العملية مقابل wkhtmltopdf
+    import os
+    import resource
+    import shutil
+    import subprocess
+    import tempfile
+    import time
+    import tracemalloc
+
+    paragraph = "الخلية هي الوحدة الأساسية في بناء الكائنات الحية، وتحتوي على النواة والسيتوبلازم والغشاء البلازمي. "
+    sample = "\n\n".join(f"## القسم {i + 1}\n" + paragraph * 6 for i in range(20))
+    runs = 20
+
+    render_text(sample, "مستند تجريبي")  # تحميل الخطوط مرة واحدة
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(runs):
+        data = render_text(sample, "مستند تجريبي")
+    elapsed = (time.perf_counter() - started) / runs
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"PyMuPDF Story: {elapsed * 1000:.1f} ms/doc, {len(data) // 1024} KB, "
+          f"peak Python heap {peak / 1024 / 1024:.1f} MB")
+
+    if shutil.which("wkhtmltopdf") is None:
+        print("wkhtmltopdf: not installed, skipped")
+    else:
+        page = f"<html><head><meta charset='UTF-8'></head><body dir='rtl'>{text_to_html(sample)}</body></html>"
+        with tempfile.TemporaryDirectory() as tmp:
+            html_path = os.path.join(tmp, "doc.html")
+            pdf_path = os.path.join(tmp, "doc.pdf")
+            with open(html_path, "w", encoding="utf-8") as f:
+                f.write(page)
+            started = time.perf_counter()
+            for _ in range(runs):
+                subprocess.run(["wkhtmltopdf", "-q", html_path, pdf_path], check=False)
+            elapsed = (time.perf_counter() - started) / runs
+            size = os.path.getsize(pdf_path) if os.path.exists(pdf_path) else 0
+        child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        print(f"wkhtmltopdf: {elapsed * 1000:.1f} ms/doc, {size // 1024} KB, peak process RSS {child_rss:.1f} MB")
@@ -0,0 +1,154 @@
+import copy
+import hashlib
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import fitz  # PyMuPDF
+
+from pdf_cache import PDFCache
+
+PDFData = Union[bytes, bytearray, memoryview]
+
+# ==================== أدوات استخراج PDF ====================
+# دوال على مستوى الوحدة حتى يمكن تمريرها إلى ProcessPoolExecutor
+
+
+def open_pdf(pdf_data: Union[PDFData, str]) -> fitz.Document:
+    """فتح المستند من الذاكرة مباشرة (يقبل memoryview دون نسخ) أو من مسار ملف"""
+    if isinstance(pdf_data, str):
+        return fitz.open(pdf_data, filetype="pdf")
+    return fitz.open(stream=pdf_data, filetype="pdf")
+
+
+def iter_pages(doc: fitz.Document, page_numbers: Optional[Iterable[int]] = None) -> Iterator[str]:
+    """إرجاع نص كل صفحة فور استخراجها دون تجميع المستند كاملاً"""
+    for page_num in range(len(doc)) if page_numbers is None else page_numbers:
+        yield doc.load_page(page_num).get_text()
+
+
+def select_pages(page_count: int, max_pages: Optional[int] = None, sample: bool = False) -> List[int]:
+    """أرقام الصفحات المطلوبة: الأولى حتى الحد، أو عينة موزعة بالتساوي على المستند كله"""
+    if max_pages is None or page_count <= max_pages:
+        return list(range(page_count))
+    if sample:
+        return [int(i * page_count / max_pages) for i in range(max_pages)]
+    return list(range(max_pages))
+
+
+@dataclass(slots=True)
+class PDFIngestResult:
+    """نتيجة مرور واحد على المستند: النص والهيكل معاً"""
+    total_pages: int = 0
+    metadata: Dict = field(default_factory=dict)
+    toc: List = field(default_factory=list)
+    fonts: Set[str] = field(default_factory=set)
+    has_images: bool = False
+    pages: List[str] = field(default_factory=list)
+    page_numbers: List[int] = field(default_factory=list)
+
+    def analysis(self) -> Dict:
+        """ملخص الهيكل بنفس صيغة analyze_pdf_structure"""
+        return {
+            "total_pages": self.total_pages,
+            "metadata": self.metadata,
+            "has_images": self.has_images,
+            "has_toc": bool(self.toc),
+            "fonts": self.fonts
+        }
+
+    def merge(self, other: "PDFIngestResult"):
+        """دمج نتيجة نطاق لاحق من الصفحات"""
+        self.pages.extend(other.pages)
+        self.page_numbers.extend(other.page_numbers)
+        self.fonts.update(other.fonts)
+        self.has_images = self.has_images or other.has_images
+
+    def to_dict(self) -> Dict:
+        # asdict ينسخ القوائم والقواميس، فلا تشارك النتيجة المحفوظة أي كائن مع result
+        return dict(asdict(self), fonts=sorted(self.fonts))
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "PDFIngestResult":
+        # نسخة عميقة: data قد تكون العنصر نفسه في ذاكرة PDFCache، وocr_empty_pages يعدل الصفحات
+        data = copy.deepcopy(data)
+        return cls(**dict(data, fonts=set(data.get("fonts", []))))
+
+
+def ingest_pages(doc: fitz.Document, result: PDFIngestResult,
+                 page_numbers: Iterable[int]) -> Iterator[str]:
+    """إرجاع نص كل صفحة مطلوبة مع جمع الهيكل في result أثناء نفس المرور
+
+    لا تُحمّل إلا الصفحات المطلوبة، فيبقى استهلاك الذاكرة محدوداً مهما كبر الملف.
+    """
+    result.total_pages = len(doc)
+    result.metadata = doc.metadata or {}
+    result.toc = doc.get_toc()
+    for page_num in page_numbers:
+        page = doc.load_page(page_num)
+        if not result.has_images and page.get_images():
+            result.has_images = True
+        result.fonts.update(font[3] for font in page.get_fonts())
+        text = page.get_text()
+        result.pages.append(text)
+        result.page_numbers.append(page_num)
+        yield text
+
+
+def ingest_page_list(pdf_data: Union[PDFData, str], page_numbers: List[int]) -> PDFIngestResult:
+    """مرور واحد على مجموعة من الصفحات داخل عامل مستقل"""
+    result = PDFIngestResult()
+    doc = open_pdf(pdf_data)
+    try:
+        for _ in ingest_pages(doc, result, page_numbers):
+            pass
+    finally:
+        doc.close()
+    return result
+
+
+# ==================== التعرف الضوئي المحلي ====================
+_ocr_cache: Optional[PDFCache] = None
+
+
+def page_hash(doc: fitz.Document, page: fitz.Page) -> str:
+    """بصمة محتوى الصفحة (أوامر الرسم والصور) لتمييز الصفحات المتطابقة بين الملفات"""
+    digest = hashlib.sha256(page.read_contents())
+    for image in page.get_images():
+        digest.update(doc.xref_stream_raw(image[0]) or b"")
+    return digest.hexdigest()
+
+
+def ocr_page(pdf_data: Union[PDFData, str], page_num: int,
+             language: str = "ara+eng", dpi: int = 300) -> str:
+    """تحويل الصفحة إلى صورة وقراءتها بـ Tesseract محلياً، مع حفظ النتيجة حسب بصمة الصفحة"""
+    global _ocr_cache
+    if _ocr_cache is None:
+        _ocr_cache = PDFCache()
+
+    doc = open_pdf(pdf_data)
+    try:
+        page = doc.load_page(page_num)
+        cache_key = PDFCache.make_key(page_hash(doc, page), "ocr", language=language, dpi=dpi)
+        cached = _ocr_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        textpage = page.get_textpage_ocr(language=language, dpi=dpi, full=True)
+        text = page.get_text(textpage=textpage)
+        _ocr_cache.set(cache_key, text)
+        return text
+    finally:
+        doc.close()
+
+
+def shard_pages(page_count: int, shards: int) -> List[Tuple[int, int]]:
+    """تقسيم الصفحات إلى نطاقات متتالية متقاربة الحجم"""
+    shards = max(1, min(shards, page_count))
+    size, extra = divmod(page_count, shards)
+    ranges = []
+    start = 0
+    for i in range(shards):
+        stop = start + size + (1 if i < extra else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
@@ -0,0 +1,176 @@
+import logging
+import re
+import time
+from collections import deque
+from typing import Dict, List, Optional, Union
+
+from arabic_text import estimate_tokens
+from retrieval import BM25Index
+
+logger = logging.getLogger(__name__)
+
+# ==================== ميزانية الرموز ====================
+PROMPT_CONFIG = {
+    # رموز المزود لكل كلمة أو علامة ترقيم (تقدير أولي للنص العربي يُعاير من الاستهلاك الفعلي)
+    "TOKENS_PER_WORD": {
+        "gemini": 1.3,
+        "chatgpt": 2.5,
+        "deepseek": 1.6,
+    },
+    "CALIBRATION_WEIGHT": 0.2,  # وزن كل قراءة جديدة من المزود في التقدير
+    "USAGE_LOG_SIZE": 200,  # عدد آخر الطلبات المحفوظة في السجل
+}
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+
+def request_text(request: Union[str, List[Dict], Dict]) -> str:
+    """النص المرسل فعلاً: محتوى الرسائل دون مفاتيح JSON وعلامات الهروب
+
+    يُعاير التقدير على نفس النص العادي الذي تقيسه count وfit.
+    """
+    if isinstance(request, str):
+        return request
+    messages = request.get("messages", []) if isinstance(request, dict) else request
+    return "\n".join(str(message.get("content", "")) for message in messages)
+
+
+class PromptBuilder:
+    """عدّ الرموز لكل مزود وملء سياق المستند بأعلى المقاطع قيمة ضمن ميزانية محددة
+
+    ويحفظ في usage رموز الإدخال والإخراج وزمن كل طلب.
+    """
+
+    def __init__(self, context_tokens: Dict[str, int], max_output_tokens: Dict[str, int],
+                 tokens_per_word: Optional[Dict[str, float]] = None, usage_log_size: Optional[int] = None):
+        self.context_tokens = dict(context_tokens)
+        self.max_output_tokens = dict(max_output_tokens)
+        self.tokens_per_word = dict(tokens_per_word or PROMPT_CONFIG["TOKENS_PER_WORD"])
+        self.usage = UsageLog(usage_log_size)
+
+    def count(self, text: str, provider: str) -> int:
+        if not text:
+            return 0
+        return max(1, round(estimate_tokens(text) * self.tokens_per_word.get(provider, 1.0)))
+
+    def calibrate(self, provider: str, text: str, reported_tokens: int):
+        """تقريب التقدير من عدد الرموز الذي أرجعه المزود لنفس النص"""
+        words = estimate_tokens(text)
+        if not words or not reported_tokens:
+            return
+        weight = PROMPT_CONFIG["CALIBRATION_WEIGHT"]
+        current = self.tokens_per_word.get(provider, 1.0)
+        self.tokens_per_word[provider] = current + weight * (reported_tokens / words - current)
+
+    def max_output(self, provider: str) -> int:
+        return self.max_output_tokens[provider]
+
+    def record(self, provider: str, model: str, request: str, output: str, latency: float,
+               input_tokens: Optional[int] = None, output_tokens: Optional[int] = None):
+        """تسجيل رموز الطلب وزمنه؛ يُقدر العدد إذا لم يرجعه المزود ويُعاير التقدير إذا أرجعه"""
+        if input_tokens:
+            self.calibrate(provider, request, input_tokens)
+        self.usage.record(
+            provider,
+            model,
+            input_tokens or self.count(request, provider),
+            output_tokens or self.count(output, provider),
+            latency,
+        )
+
+    def select(self, index: BM25Index, query: str, model: str = "auto") -> str:
+        """أعلى المقاطع صلة بالسؤال بترتيب الأهمية حتى ميزانية النموذج
+
+        مع "auto" تُستخدم أكبر ميزانية، ويقلصها fit لكل مزود عند الإرسال. إن لم يطابق
+        السؤال شيئاً (أو كان فارغاً كما في التحليل) تُختار مقاطع موزعة على كامل المستند.
+        """
+        providers = [model] if model in self.context_tokens else list(self.context_tokens)
+        provider = max(providers, key=lambda p: self.context_tokens[p])
+        budget = self.context_tokens[provider]
+
+        order = [i for i, _ in index.search(query, len(index.chunks))] if query else []
+        if not order:
+            order = self._spread(index.chunks, budget, provider)
+        return self._pack([index.chunks[i] for i in order], budget, provider)
+
+    def fit(self, context: str, provider: str) -> str:
+        """تقليص سياق مرتب بالأهمية إلى ميزانية المزود"""
+        if not context:
+            return ""
+        return self._pack(context.split(CONTEXT_SEPARATOR), self.context_tokens[provider], provider)
+
+    def _spread(self, chunks: List[str], budget: int, provider: str) -> List[int]:
+        average = sum(self.count(chunk, provider) for chunk in chunks) / max(len(chunks), 1)
+        fits = max(1, int(budget // max(average, 1)))
+        if fits >= len(chunks):
+            return list(range(len(chunks)))
+        step = (len(chunks) - 1) / max(fits - 1, 1)
+        picked = sorted({round(i * step) for i in range(fits)})
+        # ترتيب بعكس البتات: أي بداية من القائمة تبقى موزعة على المستند إذا قلصها fit
+        bits = max(len(picked) - 1, 1).bit_length()
+        ranked = sorted(enumerate(picked), key=lambda item: int(f"{item[0]:0{bits}b}"[::-1], 2))
+        return [chunk for _, chunk in ranked]
+
+    def _pack(self, chunks: List[str], budget: int, provider: str) -> str:
+        kept, used = [], 0
+        separator = self.count(CONTEXT_SEPARATOR, provider)
+        for chunk in chunks:
+            cost = self.count(chunk, provider) + separator
+            if used + cost > budget:
+                if not kept:
+                    kept.append(self._truncate(chunk, budget, provider))
+                    used = budget
+                continue
+            kept.append(chunk)
+            used += cost
+        return CONTEXT_SEPARATOR.join(kept)
+
+    def _truncate(self, text: str, budget: int, provider: str) -> str:
+        cost = self.count(text, provider)
+        if cost <= budget:
+            return text
+        cut = text[:int(len(text) * budget / cost)]
+        # القطع عند آخر مسافة حتى لا تنقسم كلمة
+        match = re.search(r"\s\S*$", cut)
+        return cut[:match.start()] if match else cut
+
+
+class UsageLog:
+    """رموز الإدخال والإخراج وزمن كل طلب، مع مجاميع لكل مزود"""
+
+    def __init__(self, size: Optional[int] = None):
+        self.requests: deque = deque(maxlen=size or PROMPT_CONFIG["USAGE_LOG_SIZE"])
+        self.totals: Dict[str, Dict] = {}
+
+    def record(self, provider: str, model: str, input_tokens: int, output_tokens: int, latency: float):
+        self.requests.append({
+            "time": time.time(),
+            "provider": provider,
+            "model": model,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "latency": latency,
+        })
+        totals = self.totals.setdefault(
+            provider, {"requests": 0, "input_tokens": 0, "output_tokens": 0, "latency": 0.0}
+        )
+        totals["requests"] += 1
+        totals["input_tokens"] += input_tokens
+        totals["output_tokens"] += output_tokens
+        totals["latency"] += latency
+        logger.info(f"{provider}/{model}: {input_tokens} in, {output_tokens} out tokens in {latency:.2f}s")
+
+    def summary(self) -> Dict[str, Dict]:
+        """متوسطات كل مزود: الرموز لكل طلب والزمن وسرعة الإخراج"""
+        return {
+            provider: {
+                "requests": totals["requests"],
+                "input_tokens": totals["input_tokens"],
+                "output_tokens": totals["output_tokens"],
+                "avg_input": totals["input_tokens"] / totals["requests"],
+                "avg_output": totals["output_tokens"] / totals["requests"],
+                "avg_latency": totals["latency"] / totals["requests"],
+                "output_per_sec": totals["output_tokens"] / totals["latency"] if totals["latency"] else 0.0,
+            }
+            for provider, totals in self.totals.items()
+        }
@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from arabic_text import normalize_arabic, tokenize
+
+logger = logging.getLogger(__name__)
+
+# ==================== إعدادات بنك الأسئلة ====================
+QUESTION_BANK_CONFIG = {
+    "DB_PATH": os.environ.get("QUESTION_BANK_PATH", "question_bank.sqlite3"),
+    "SHINGLE_SIZE": 4,  # طول المقاطع الحرفية لمقارنة التشابه
+    # نسبة التشابه (Jaccard) بين السؤال وخياراته وإجابته التي يُعد عندها مكرراً،
+    # بشرط تطابق الإجابة والأرقام
+    "NEAR_DUPLICATE": 0.75,
+    # MinHash مقسم إلى نطاقات: الأسئلة المشتركة في نطاق واحد على الأقل فقط تُقارن بدقة
+    "MINHASH_BANDS": 8,
+    "MINHASH_ROWS": 4,
+    "CANDIDATES": 20,  # أقصى عدد للمقارنات الدقيقة لكل سؤال (الأكثر اشتراكاً في النطاقات)
+}
+
+NON_WORD = re.compile(r"[\W_]+")
+NUMBER = re.compile(r"\d+")
+KEY_SEPARATOR = " | "
+
+
+def _normalize(text) -> str:
+    return NON_WORD.sub(" ", normalize_arabic(str(text))).strip()
+
+
+def question_key(question: Dict) -> str:
+    """نص السؤال وخياراته (مرتبة) وإجابته بعد التوحيد؛ بصمته وأساس مقارنة التشابه
+
+    الإجابة آخر جزء في المفتاح. أسئلة بنفس الصيغة العامة ("أي مما يلي صحيح؟")
+    تختلف بخياراتها فلا تُعد مكررة.
+    """
+    options = sorted(_normalize(option) for option in question.get("options", []))
+    return KEY_SEPARATOR.join([_normalize(question["question"]), *options,
+                               _normalize(question.get("answer", ""))])
+
+
+def _answer(key: str) -> str:
+    return key.rsplit(KEY_SEPARATOR, 1)[-1]
+
+
+def _same_facts(a: str, b: str) -> bool:
+    """نفس الإجابة ونفس الأرقام: "12 + 15" و"12 + 16" سؤالان مختلفان مهما تشابه النص"""
+    if _answer(a) != _answer(b):
+        return False
+    return sorted(int(n) for n in NUMBER.findall(a)) == sorted(int(n) for n in NUMBER.findall(b))
+
+
+def shingles(text: str, size: Optional[int] = None) -> Set[str]:
+    """مقاطع حرفية متداخلة من النص الموحد (تتحمل اختلاف السوابق والصياغة البسيطة)"""
+    size = size or QUESTION_BANK_CONFIG["SHINGLE_SIZE"]
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def similarity(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def lsh_bands(shingle_set: Set[str], prefix: str = "") -> List[str]:
+    """مفاتيح نطاقات MinHash؛ تشابه 0.75 يشترك في نطاق واحد على الأقل باحتمال يقارب 95%
+
+    يُحسب التوقيع بتبديل واحد (one permutation hashing): كل مقطع يُوزع على خانة
+    حسب قيمته ويُحفظ أصغر ما في كل خانة، فيكفي مرور واحد على المقاطع.
+    """
+    if not shingle_set:
+        return []
+    rows = QUESTION_BANK_CONFIG["MINHASH_ROWS"]
+    slots = QUESTION_BANK_CONFIG["MINHASH_BANDS"] * rows
+    signature = [-1] * slots
+    for shingle in shingle_set:
+        value = zlib.crc32(shingle.encode("utf-8"))
+        slot, rank = value % slots, value // slots
+        if signature[slot] < 0 or rank < signature[slot]:
+            signature[slot] = rank
+    return [
+        f"{prefix}{band}:" + ",".join(map(str, signature[band * rows:(band + 1) * rows]))
+        for band in range(QUESTION_BANK_CONFIG["MINHASH_BANDS"])
+    ]
+
+
+def question_bands(key: str) -> List[str]:
+    """نطاقات المفتاح مسبوقة ببصمة الإجابة: المرشحون للتكرار يشتركون في الإجابة أصلاً"""
+    return lsh_bands(shingles(key), f"{zlib.crc32(_answer(key).encode('utf-8')):x}/")
+
+
+def _match_query(text: str) -> str:
+    """تحويل النص إلى استعلام FTS5 آمن من كلمات موحدة (كل الكلمات مطلوبة)"""
+    return " ".join(f'"{term}"' for term in dict.fromkeys(tokenize(text)))
+
+
+class QuestionBank:
+    """بنك أسئلة دائم (SQLite) مع بحث نصي كامل واكتشاف الأسئلة المكررة عند الإضافة"""
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or QUESTION_BANK_CONFIG["DB_PATH"]
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS questions (
+                id INTEGER PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                question TEXT NOT NULL,
+                options TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                doc_hash TEXT NOT NULL DEFAULT '',
+                difficulty TEXT NOT NULL DEFAULT '',
+                q_type TEXT NOT NULL DEFAULT '',
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_questions_fingerprint ON questions (fingerprint);
+            CREATE INDEX IF NOT EXISTS idx_questions_tags ON questions (doc_hash, difficulty, q_type);
+            CREATE TABLE IF NOT EXISTS question_bands (
+                band TEXT NOT NULL,
+                id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_question_bands ON question_bands (band);
+            CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+                terms, tokenize='unicode61 remove_diacritics 2'
+            );
+            """
+        )
+        self._conn.commit()
+
+    def _near_duplicate(self, fingerprint: str, bands: List[str]) -> Optional[int]:
+        if not bands:
+            return None
+        rows = self._conn.execute(
+            "SELECT q.id, q.fingerprint FROM question_bands b JOIN questions q ON q.id = b.id "
+            f"WHERE b.band IN ({','.join('?' * len(bands))}) "
+            "GROUP BY q.id ORDER BY COUNT(*) DESC LIMIT ?",
+            (*bands, QUESTION_BANK_CONFIG["CANDIDATES"]),
+        ).fetchall()
+        target = shingles(fingerprint)
+        for question_id, other in rows:
+            if not _same_facts(fingerprint, other):
+                continue
+            if similarity(target, shingles(other)) >= QUESTION_BANK_CONFIG["NEAR_DUPLICATE"]:
+                return question_id
+        return None
+
+    def find_duplicate(self, question: Dict) -> Optional[int]:
+        """رقم سؤال مطابق أو شبه مطابق موجود في البنك"""
+        fingerprint = question_key(question)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM questions WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+            if row is not None:
+                return row[0]
+            return self._near_duplicate(fingerprint, question_bands(fingerprint))
+
+    def _insert(self, question: Dict, doc_hash: str, difficulty: str, q_type: str) -> Optional[int]:
+        fingerprint = question_key(question)
+        exists = self._conn.execute(
+            "SELECT 1 FROM questions WHERE fingerprint = ?", (fingerprint,)
+        ).fetchone()
+        if exists:
+            return None
+        bands = question_bands(fingerprint)
+        if self._near_duplicate(fingerprint, bands) is not None:
+            return None
+
+        options = [str(option) for option in question.get("options", [])]
+        cursor = self._conn.execute(
+            "INSERT INTO questions (fingerprint, question, options, answer, doc_hash, difficulty, q_type, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (fingerprint, question["question"], json.dumps(options, ensure_ascii=False),
+             str(question.get("answer", "")), doc_hash, difficulty, q_type, time.time()),
+        )
+        terms = " ".join(tokenize(" ".join([question["question"], *options])))
+        self._conn.execute("INSERT INTO questions_fts (rowid, terms) VALUES (?, ?)", (cursor.lastrowid, terms))
+        self._conn.executemany(
+            "INSERT INTO question_bands (band, id) VALUES (?, ?)", [(band, cursor.lastrowid) for band in bands]
+        )
+        return cursor.lastrowid
+
+    def add_many(self, questions: Iterable[Dict], doc_hash: str = "", difficulty: str = "",
+                 q_type: str = "") -> Tuple[int, int]:
+        """إضافة الأسئلة غير المكررة في معاملة واحدة؛ يُرجع (المضاف، المكرر)"""
+        added = duplicates = 0
+        try:
+            with self._lock:
+                for question in questions:
+                    if self._insert(question, doc_hash, difficulty, q_type) is None:
+                        duplicates += 1
+                    else:
+                        added += 1
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Question bank write error: {e}")
+        return added, duplicates
+
+    def add(self, question: Dict, doc_hash: str = "", difficulty: str = "", q_type: str = "") -> bool:
+        return self.add_many([question], doc_hash, difficulty, q_type)[0] == 1
+
+    def _where(self, query: str, doc_hash: Optional[str], difficulty: Optional[str],
+               q_type: Optional[str]) -> Tuple[str, List]:
+        clauses, params = [], []
+        match = _match_query(query) if query else ""
+        if match:
+            clauses.append("q.id IN (SELECT rowid FROM questions_fts WHERE questions_fts MATCH ?)")
+            params.append(match)
+        for column, value in (("doc_hash", doc_hash), ("difficulty", difficulty), ("q_type", q_type)):
+            if value:
+                clauses.append(f"q.{column} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def search(self, query: str = "", doc_hash: Optional[str] = None, difficulty: Optional[str] = None,
+               q_type: Optional[str] = None, limit: int = 50, offset: int = 0) -> List[Dict]:
+        """البحث بالنص (دون حساسية للتشكيل والسوابق) مع التصفية بالوسوم، الأحدث أولاً"""
+        where, params = self._where(query, doc_hash, difficulty, q_type)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT q.id, q.question, q.options, q.answer, q.doc_hash, q.difficulty, q.q_type "
+                f"FROM questions q{where} ORDER BY q.id DESC LIMIT ? OFFSET ?",
+                (*params, limit, offset),
+            ).fetchall()
+        return [
+            {
+                "id": row[0],
+                "question": row[1],
+                "options": json.loads(row[2]),
+                "answer": row[3],
+                "doc_hash": row[4],
+                "difficulty": row[5],
+                "q_type": row[6],
+            }
+            for row in rows
+        ]
+
+    def count(self, query: str = "", doc_hash: Optional[str] = None, difficulty: Optional[str] = None,
+              q_type: Optional[str] = None) -> int:
+        where, params = self._where(query, doc_hash, difficulty, q_type)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM questions q{where}", params).fetchone()[0]
+
+    def delete(self, question_ids: Iterable[int]) -> int:
+        ids = [(question_id,) for question_id in question_ids]
+        with self._lock:
+            cursor = self._conn.executemany("DELETE FROM questions WHERE id = ?", ids)
+            self._conn.executemany("DELETE FROM questions_fts WHERE rowid = ?", ids)
+            self._conn.executemany("DELETE FROM question_bands WHERE id = ?", ids)
+            self._conn.commit()
+            return cursor.rowcount
+
+
+if __name__ == "__main__":
+    # قياس سريع: زمن الإضافة مع فحص التكرار وزمن البحث على بضعة آلاف سؤال
+    import random
+    import tempfile
+
+    words = ("الخلية النواة الغشاء البلازمي الميتوكوندريا الطاقة البروتين الإنزيم التنفس "
+             "البناء الضوئي الكروموسوم الجين الوراثة الانقسام الريبوسوم السيتوبلازم").split()
+    rng = random.Random(1)
+    sample = [
+        {
+            "question": f"ما العلاقة بين {' و'.join(rng.sample(words, 3))} في {rng.choice(words)}؟",
+            "options": rng.sample(words, 3),
+            "answer": rng.choice(words),
+        }
+        for _ in range(5000)
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        bank = QuestionBank(os.path.join(tmp, "bank.sqlite3"))
+        started = time.perf_counter()
+        added, duplicates = bank.add_many(sample, "doc", "متوسط", "mcq")
+        elapsed = time.perf_counter() - started
+        print(f"insert {len(sample)}: {added} added, {duplicates} duplicates in {elapsed:.2f}s")
+        started = time.perf_counter()
+        for word in words:
+            bank.search(word, difficulty="متوسط", limit=50)
+            bank.count(word)
+        elapsed = (time.perf_counter() - started) / len(words)
+        print(f"search + count: {elapsed * 1000:.1f} ms/query over {bank.count()} questions")
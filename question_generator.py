@@ -0,0 +1,206 @@
+import logging
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import takewhile
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from arabic_text import normalize_arabic
+from question_parser import QuestionStreamParser
+
+logger = logging.getLogger(__name__)
+
+# ==================== إعدادات التوليد ====================
+GENERATION_CONFIG = {
+    "CHUNK_CHARS": 8000,  # حجم المقطع الواحد بالأحرف
+    "MAX_CONCURRENCY": 8,  # أقصى عدد طلبات متزامنة للنموذج
+    "DEFAULT_QUESTIONS": 10,  # عدد الأسئلة إن لم يحدده المستخدم
+    "MAX_QUESTIONS": 100,
+}
+
+PAGE_MARKER = re.compile(r"(?m)^=== صفحة \d+ ===$")
+
+
+# ==================== تقسيم المستند ====================
+def split_into_chunks(text: str, max_size: Optional[int] = None,
+                      measure: Callable[[str], int] = len) -> List[str]:
+    """تقسيم المستند إلى مقاطع حسب الصفحات أو الفقرات دون تجاوز الحجم المحدد
+
+    الحجم بالأحرف افتراضياً، أو بأي مقياس آخر مثل عدد رموز النموذج.
+    """
+    max_size = max_size or GENERATION_CONFIG["CHUNK_CHARS"]
+    if PAGE_MARKER.search(text):
+        units = [u for u in PAGE_MARKER.split(text) if u.strip()]
+    else:
+        units = [u for u in re.split(r"\n\s*\n", text) if u.strip()]
+
+    chunks = []
+    current: List[str] = []
+    size = 0
+    for unit in units:
+        unit_size = measure(unit)
+        # فقرة أطول من الحد تُقسم مباشرة
+        while unit_size > max_size:
+            if current:
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+            cut = max(1, int(len(unit) * max_size / unit_size))
+            chunks.append(unit[:cut])
+            unit = unit[cut:]
+            unit_size = measure(unit)
+        if size + unit_size > max_size and current:
+            chunks.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(unit)
+        size += unit_size
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def allocate_questions(total: int, chunk_count: int) -> List[Tuple[int, int]]:
+    """توزيع عدد الأسئلة على مقاطع موزعة بالتساوي عبر المستند"""
+    if total <= 0 or chunk_count <= 0:
+        return []
+    if total < chunk_count:
+        return [(int((i + 0.5) * chunk_count / total), 1) for i in range(total)]
+    base, extra = divmod(total, chunk_count)
+    return [(i, base + (1 if i < extra else 0)) for i in range(chunk_count)]
+
+
+def requested_count(prompt: str) -> int:
+    """استخراج عدد الأسئلة المطلوب من نص الطلب"""
+    match = re.search(r"\d+", prompt)
+    count = int(match.group()) if match else GENERATION_CONFIG["DEFAULT_QUESTIONS"]
+    return max(1, min(count, GENERATION_CONFIG["MAX_QUESTIONS"]))
+
+
+# ==================== تحليل الأسئلة ====================
+def iter_complete_questions(parts: Iterable[str]) -> Iterator[Dict]:
+    """تحليل الأسئلة من رد متدفق فور اكتمال كل كتلة :::نهاية:::"""
+    parser = QuestionStreamParser()
+    for part in parts:
+        yield from parser.feed(part)
+    yield from parser.close()
+    for error in parser.errors:
+        logger.warning(f"Skipped malformed question block {error['block']}: {error['reason']}")
+
+
+def question_fingerprint(question: Dict) -> str:
+    """بصمة مبسطة لنص السؤال وخياراته (مرتبة) لاكتشاف التكرار
+
+    الصيغ العامة مثل "أي مما يلي صحيح؟" تتكرر بين المقاطع بخيارات مختلفة.
+    """
+    def compact(text) -> str:
+        return re.sub(r"[\W_]+", "", normalize_arabic(str(text)))
+
+    stem = compact(question["question"])
+    if not stem:
+        return ""
+    return "|".join([stem, *sorted(compact(option) for option in question.get("options", []))])
+
+
+# ==================== التوليد الموزع ====================
+def build_exam_prompt(chunk: str, request: str, difficulty: str, q_type: str,
+                      count: int, part: int, parts: int) -> str:
+    return f"""
+            Context: You are an expert educational AI.
+            Document Section ({part}/{parts}): {chunk}
+
+            User Request: {request}
+
+            INSTRUCTION: Generate exactly {count} {difficulty} questions of type {q_type} from this section only.
+            OUTPUT PATTERN STRICTLY:
+            :::سؤال::: [Question Text] || [Option A] || [Option B] || [Option C] || [Correct Answer] :::نهاية:::
+
+            Rules:
+            1. Separator must be "||".
+            2. Language: Arabic.
+            3. Do NOT use Markdown code blocks. Just raw text.
+            """
+
+
+def iter_questions(
+    text: str,
+    request: str,
+    difficulty: str,
+    q_type: str,
+    total: int,
+    generate: Callable[[str], Iterable[str]],
+    max_concurrency: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+    measure: Callable[[str], int] = len,
+) -> Iterator[Dict]:
+    """توليد الأسئلة من كامل المستند بإرسال المقاطع بالتوازي وإرجاع كل سؤال فور اكتماله
+
+    الدالة generate تُرجع الرد على أجزاء متتالية (بث) لكل طلب. يُحدد حجم المقطع بـ
+    chunk_size مقيساً بـ measure (ميزانية رموز النموذج مثلاً)، وإلا فبالأحرف.
+
+    يبدأ التوليد بعد اكتمال استخراج المستند لا من أول صفحة: normalize_pages تحتاج كل
+    الصفحات لاكتشاف الترويسات والفقرات المكررة، وتوزيع الأسئلة يحتاج عدد المقاطع كله.
+    في التطبيق والبوت يطلب المستخدم الأسئلة بعد الرفع أصلاً، وفي batch_generate يتداخل
+    استخراج الملفات التالية مع توليد أسئلة الملف الحالي.
+    """
+    chunks = split_into_chunks(text, chunk_size, measure)
+    plan = allocate_questions(total, len(chunks))
+    results: "queue.Queue[Optional[Dict]]" = queue.Queue()
+    # يُضبط عند اكتمال العدد أو توقف المستهلك؛ إلغاء المهام لا يوقف مقاطع بدأ بثها
+    stop = threading.Event()
+
+    def run(item: Tuple[int, int]):
+        index, count = item
+        parts = None
+        try:
+            if stop.is_set():
+                return
+            prompt = build_exam_prompt(chunks[index], request, difficulty, q_type,
+                                       count, index + 1, len(chunks))
+            parts = iter(generate(prompt))
+            for question in iter_complete_questions(takewhile(lambda _: not stop.is_set(), parts)):
+                if stop.is_set():
+                    break
+                results.put(question)
+        except Exception as e:
+            logger.error(f"Chunk {index + 1} generation error: {e}")
+        finally:
+            # إغلاق البث المفتوح بدلاً من قراءته حتى النهاية
+            if stop.is_set() and hasattr(parts, "close"):
+                parts.close()
+            results.put(None)  # علامة انتهاء المقطع
+
+    workers = max_concurrency or GENERATION_CONFIG["MAX_CONCURRENCY"]
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(plan) or 1)))
+    try:
+        for item in plan:
+            pool.submit(run, item)
+
+        seen = set()
+        produced = 0
+        pending = len(plan)
+        while pending and produced < total:
+            question = results.get()
+            if question is None:
+                pending -= 1
+                continue
+            fingerprint = question_fingerprint(question)
+            if fingerprint and fingerprint not in seen:
+                seen.add(fingerprint)
+                produced += 1
+                yield question
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def generate_questions(
+    text: str,
+    request: str,
+    difficulty: str,
+    q_type: str,
+    total: int,
+    generate: Callable[[str], Iterable[str]],
+    max_concurrency: Optional[int] = None,
+) -> List[Dict]:
+    """توليد الأسئلة من كامل المستند ثم إرجاعها كقائمة"""
+    return list(iter_questions(text, request, difficulty, q_type, total, generate, max_concurrency))
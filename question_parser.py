@@ -0,0 +1,137 @@
+import re
+from typing import Dict, List, Optional
+
+# ==================== تحليل بروتوكول الأسئلة ====================
+# :::سؤال::: نص السؤال || خيار || خيار || الإجابة :::نهاية:::
+
+START_MARKER = ":::سؤال:::"
+END_MARKER = ":::نهاية:::"
+
+FENCE = re.compile(r"^\s*```[\w-]*\s*$", re.MULTILINE)
+
+
+class QuestionStreamParser:
+    """محلل تدريجي يستقبل الرد على أجزاء ويُرجع كل سؤال فور إغلاق كتلته
+
+    يعمل في زمن خطي: كل جزء يُفحص مرة واحدة، ولا يُحتفظ إلا بالكتلة المفتوحة
+    وذيل قصير قد يحمل بداية علامة مقطوعة.
+    """
+
+    def __init__(self):
+        self._carry = ""
+        self._parts: List[str] = []
+        self._in_block = False
+        self.blocks = 0
+        self.errors: List[Dict] = []
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """إضافة جزء من الرد وإرجاع الأسئلة التي اكتملت"""
+        questions = []
+        text = self._carry + chunk
+        self._carry = ""
+        # المسح بموضع داخل النص بدلاً من قص الباقي بعد كل كتلة (القص ينسخ الباقي كله)
+        pos = 0
+
+        while pos < len(text):
+            if not self._in_block:
+                start = text.find(START_MARKER, pos)
+                if start == -1:
+                    self._carry = text[max(pos, len(text) - (len(START_MARKER) - 1)):]
+                    break
+                self._in_block = True
+                pos = start + len(START_MARKER)
+                continue
+
+            end = text.find(END_MARKER, pos)
+            next_start = text.find(START_MARKER, pos, end if end != -1 else len(text))
+            if next_start != -1:
+                # كتلة بلا علامة نهاية تليها كتلة جديدة
+                self._parts.append(text[pos:next_start])
+                self._close_block(questions, missing_end=True)
+                pos = next_start
+                continue
+
+            if end == -1:
+                keep = len(END_MARKER) - 1
+                if len(text) - pos > keep:
+                    self._parts.append(text[pos:-keep])
+                    self._carry = text[-keep:]
+                else:
+                    self._carry = text[pos:]
+                break
+
+            self._parts.append(text[pos:end])
+            self._close_block(questions)
+            pos = end + len(END_MARKER)
+
+        return questions
+
+    def close(self) -> List[Dict]:
+        """إنهاء البث؛ كتلة لم تُغلق في آخر الرد مقطوعة (حد رموز الإخراج مثلاً) فتُسجل خطأً ولا تُرجع"""
+        if self._in_block:
+            self._parts.append(self._carry)
+            self._carry = ""
+            body = self._take_block()
+            self._add_error("reply ended before end marker", body)
+        return []
+
+    def _take_block(self) -> str:
+        body = "".join(self._parts)
+        self._parts = []
+        self._in_block = False
+        self.blocks += 1
+        return body
+
+    def _add_error(self, reason: str, body: str):
+        self.errors.append({"block": self.blocks, "reason": reason, "text": body.strip()[:200]})
+
+    def _close_block(self, questions: List[Dict], missing_end: bool = False):
+        # missing_end: الكتلة انتهت ببداية كتلة تالية لا بعلامة النهاية، وهي مقبولة إن اكتملت أجزاؤها
+        body = self._take_block()
+        question = parse_block(body)
+        if question is None:
+            reason = "too few parts (block ended by next start marker)" if missing_end else "too few parts"
+            self._add_error(reason, body)
+        else:
+            questions.append(question)
+
+
+def parse_block(body: str) -> Optional[Dict]:
+    """تحويل محتوى كتلة واحدة إلى سؤال، مع تحمل غياب الفواصل والأسوار"""
+    body = FENCE.sub("", body).strip()
+    for separator in ("||", "|", "\n"):
+        parts = [p.strip() for p in body.split(separator) if p.strip()]
+        if len(parts) >= 3:
+            return {
+                "question": parts[0],
+                "options": parts[1:-1],
+                "answer": parts[-1]
+            }
+    return None
+
+
+def parse_questions(text: str) -> List[Dict]:
+    parser = QuestionStreamParser()
+    return parser.feed(text) + parser.close()
+
+
+if __name__ == "__main__":
+    # قياس سريع: معدل التحليل ثابت تقريباً مع تضاعف حجم الرد
+    import time
+
+    block = f"{START_MARKER} ما عاصمة مصر؟ || القاهرة || الإسكندرية || أسوان || القاهرة {END_MARKER}\n"
+    for size_mb in (1, 2, 4, 8):
+        reply = block * (size_mb * 1024 * 1024 // len(block.encode("utf-8")))
+        parser = QuestionStreamParser()
+        started = time.perf_counter()
+        count = 0
+        for i in range(0, len(reply), 64):
+            count += len(parser.feed(reply[i:i + 64]))
+        count += len(parser.close())
+        elapsed = time.perf_counter() - started
+        # الرد كاملاً في جزء واحد كما في parse_questions والتوليد غير المتدفق
+        started = time.perf_counter()
+        whole = len(parse_questions(reply))
+        whole_elapsed = time.perf_counter() - started
+        print(f"{size_mb} MB: {count} questions in {elapsed:.2f}s ({size_mb / elapsed:.1f} MB/s streamed), "
+              f"{whole} in {whole_elapsed:.2f}s ({size_mb / whole_elapsed:.1f} MB/s whole reply)")
@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from arabic_text import normalize_arabic
+from exam_export import question_set_hash
+
+# ==================== مخزن الأسئلة ====================
+
+
+@dataclass(slots=True)
+class QuestionRecord:
+    """سؤال واحد بمعرف ثابت لا يتغير عند حذف غيره"""
+    id: int
+    question: str
+    options: Tuple[str, ...]
+    answer: str
+    difficulty: str = ""
+    q_type: str = ""
+    search_text: str = ""
+
+    def to_dict(self) -> Dict:
+        return {"question": self.question, "options": list(self.options), "answer": self.answer}
+
+
+class QuestionStore:
+    """أسئلة الجلسة مرتبة حسب الإضافة، مع بحث وتصفية وتقسيم إلى صفحات"""
+
+    def __init__(self):
+        self._records: Dict[int, QuestionRecord] = {}
+        self._next_id = 1
+        self.version = 0
+        self._hash: Optional[Tuple[int, str]] = None
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[QuestionRecord]:
+        return iter(self._records.values())
+
+    def add(self, question: Dict, difficulty: str = "", q_type: str = "") -> int:
+        record = QuestionRecord(
+            id=self._next_id,
+            question=question["question"],
+            options=tuple(question.get("options", ())),
+            answer=question.get("answer", ""),
+            difficulty=difficulty,
+            q_type=q_type,
+        )
+        # نص موحد يُحسب مرة واحدة للبحث دون حساسية للتشكيل وأشكال الألف
+        record.search_text = normalize_arabic(" ".join((record.question, *record.options, record.answer)))
+        self._records[record.id] = record
+        self._next_id += 1
+        self.version += 1
+        return record.id
+
+    def extend(self, questions: Iterable[Dict], difficulty: str = "", q_type: str = "") -> List[int]:
+        return [self.add(question, difficulty, q_type) for question in questions]
+
+    def get(self, question_id: int) -> Optional[QuestionRecord]:
+        return self._records.get(question_id)
+
+    def remove(self, question_ids: Iterable[int]) -> int:
+        removed = 0
+        for question_id in question_ids:
+            if self._records.pop(question_id, None) is not None:
+                removed += 1
+        if removed:
+            self.version += 1
+        return removed
+
+    def clear(self):
+        self._records.clear()
+        self.version += 1
+
+    def filter(self, query: str = "", difficulty: Optional[str] = None,
+               q_type: Optional[str] = None) -> List[QuestionRecord]:
+        """الأسئلة المطابقة للبحث والتصفية بترتيب الإضافة"""
+        terms = normalize_arabic(query).split()
+        return [
+            record for record in self._records.values()
+            if (not difficulty or record.difficulty == difficulty)
+            and (not q_type or record.q_type == q_type)
+            and all(term in record.search_text for term in terms)
+        ]
+
+    def as_dicts(self) -> List[Dict]:
+        return [record.to_dict() for record in self._records.values()]
+
+    def content_hash(self) -> str:
+        """بصمة المحتوى، تُحسب مرة واحدة لكل تعديل"""
+        if self._hash is None or self._hash[0] != self.version:
+            self._hash = (self.version, question_set_hash(self.as_dicts()))
+        return self._hash[1]
+
+
+def paginate(records: List, page: int, page_size: int) -> Tuple[List, int]:
+    """عناصر الصفحة المطلوبة (تبدأ من 1) وعدد الصفحات"""
+    pages = max(1, -(-len(records) // page_size))
+    page = min(max(page, 1), pages)
+    start = (page - 1) * page_size
+    return records[start:start + page_size], pages
@@ -0,0 +1,58 @@
+import math
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from arabic_text import tokenize
+from question_generator import split_into_chunks
+
+# ==================== إعدادات الاسترجاع ====================
+RETRIEVAL_CONFIG = {
+    "CHUNK_CHARS": 700,  # حجم المقطع المفهرس بالأحرف
+    "K1": 1.5,
+    "B": 0.75,
+}
+
+
+class BM25Index:
+    """فهرس BM25 لمقاطع مستند واحد، يُبنى مرة واحدة عند رفع الملف"""
+
+    def __init__(self, chunks: List[str], k1: Optional[float] = None, b: Optional[float] = None):
+        self.chunks = chunks
+        self.k1 = k1 or RETRIEVAL_CONFIG["K1"]
+        self.b = b or RETRIEVAL_CONFIG["B"]
+        self.term_freqs: List[Counter] = [Counter(tokenize(chunk)) for chunk in chunks]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+        doc_freq: Counter = Counter()
+        for tf in self.term_freqs:
+            doc_freq.update(tf.keys())
+        total = len(chunks)
+        self.idf: Dict[str, float] = {
+            term: math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for term, df in doc_freq.items()
+        }
+
+    @classmethod
+    def from_text(cls, text: str, chunk_chars: Optional[int] = None) -> "BM25Index":
+        return cls(split_into_chunks(text, chunk_chars or RETRIEVAL_CONFIG["CHUNK_CHARS"]))
+
+    def search(self, query: str, top_k: Optional[int] = None) -> List[Tuple[int, float]]:
+        """المقاطع المطابقة مرتبة بالصلة بالسؤال (رقم المقطع، الدرجة)، كلها أو أعلى top_k"""
+        terms = [t for t in set(tokenize(query)) if t in self.idf]
+        if not terms:
+            return []
+
+        scores = []
+        for index, tf in enumerate(self.term_freqs):
+            length_norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / (self.avg_length or 1))
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + length_norm)
+            if score > 0:
+                scores.append((index, score))
+
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:top_k]
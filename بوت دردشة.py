@@ -1,13 +1,24 @@
 import logging
 import asyncio
 import io
+import json
+import mmap
 import tempfile
 import os
-import requests
-import fitz  # PyMuPDF
-from datetime import datetime
-from typing import Dict, List, Optional
+import random
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
+import httpx
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -17,7 +28,24 @@ from telegram.ext import (
     filters
 )
 import google.generativeai as genai
-from openai import OpenAI
+from openai import AsyncOpenAI
+
+from arabic_text import normalize_pages
+from llm_cache import ResponseCache
+from pdf_cache import PDFCache, document_hash
+from pdf_render import render_text
+from prompt_budget import PromptBuilder, request_text
+from retrieval import BM25Index
+from pdf_tools import (
+    PDFData,
+    PDFIngestResult,
+    ingest_page_list,
+    ingest_pages,
+    ocr_page,
+    open_pdf,
+    select_pages,
+    shard_pages
+)
 
 # ==================== إعدادات التكوين ====================
 CONFIG = {
@@ -36,8 +64,90 @@ CONFIG = {
     # OCR API (اختياري)
     "OCR_API_URL": "https://sii3.top/api/OCR.php",
     
+    # OCR محلي للصفحات الممسوحة ضوئياً (يتطلب تثبيت Tesseract مع بيانات اللغة العربية)
+    "OCR_ENABLED": True,
+    "OCR_LANGUAGE": "ara+eng",
+    "OCR_DPI": 300,
+    
     "MAX_PDF_PAGES": 50,  # أقصى عدد صفحات للمعالجة
     "MAX_FILE_SIZE": 20 * 1024 * 1024,  # 20MB
+    "SPOOL_THRESHOLD": 5 * 1024 * 1024,  # الملفات الأكبر تُحفظ في ملف مؤقت وتُربط بالذاكرة (mmap)
+    "OVERSIZE_MODE": "sample",  # عند تجاوز MAX_PDF_PAGES: "sample" عينة موزعة، "first" الصفحات الأولى، "reject" رفض
+    "PDF_WORKERS": os.cpu_count() or 2,  # عدد العمليات لاستخراج الملفات الكبيرة
+    "PARALLEL_MIN_PAGES": 40,  # أقل عدد صفحات لتفعيل الاستخراج المتوازي
+    
+    # إعدادات اتصالات HTTP المشتركة (DeepSeek و OCR)
+    "HTTP_MAX_CONNECTIONS": 20,
+    "HTTP_MAX_KEEPALIVE": 10,
+    "HTTP_KEEPALIVE_EXPIRY": 30,  # ثانية
+    "HTTP_CONNECT_TIMEOUT": 10,
+    "HTTP_READ_TIMEOUT": 60,
+    
+    # تخزين جلسات المستخدمين: "memory" أو "sqlite"
+    "SESSION_BACKEND": "memory",
+    "SESSION_DB_PATH": "sessions.sqlite3",
+    "SESSION_TTL": 7 * 24 * 3600,  # ثانية
+    "SESSION_MAX_USERS": 50000,
+    "SESSION_MAX_BYTES": 512 * 1024 * 1024,  # حجم نصوص PDF في الذاكرة
+    "RETRIEVAL_MAX_INDEXES": 256,  # عدد فهارس البحث المحفوظة في الذاكرة
+    
+    # أقل فاصل زمني بين تعديلات رسالة الرد أثناء البث (حدود Telegram: نحو 20 تعديلاً في الدقيقة في المجموعات)
+    "STREAM_EDIT_INTERVAL": 3.0,
+    
+    # أقصى عدد طلبات متزامنة لكل نموذج (حتى لا يتجمد البوت ولا تُستنزف الحصة)
+    "PROVIDER_CONCURRENCY": {
+        "gemini": 8,
+        "chatgpt": 8,
+        "deepseek": 8,
+    },
+    
+    # التوجيه التلقائي بين النماذج (model_auto)
+    "ROUTER_WINDOW": 50,  # عدد آخر الطلبات المحسوب عليها زمن الاستجابة ونسبة الأخطاء
+    "ROUTER_MIN_SAMPLES": 5,  # أقل عدد عينات قبل الاعتماد على إحصائيات النموذج
+    "ROUTER_MAX_ERROR_RATE": 0.5,  # النموذج الأعلى أخطاءً يُؤخر في الترتيب
+    "ROUTER_HEDGE": True,  # إرسال نفس الطلب لنموذج ثانٍ إذا تأخر الأول
+    "ROUTER_HEDGE_DELAY": 8,  # ثوانٍ قبل الإرسال الثاني حتى تتوفر عينات كافية (بعدها p95)
+    
+    # تحديد المعدل: دفعة أولى بحجم BURST ثم RATE طلب في الثانية
+    "USER_RATE": 5 / 60,  # 5 طلبات في الدقيقة لكل مستخدم
+    "USER_BURST": 3,
+    "RATE_LIMIT_MAX_USERS": 10000,  # عدد المستخدمين المتتبعين في الذاكرة
+    "PROVIDER_RATE": {  # حسب حصة كل مزود
+        "gemini": 1.0,
+        "chatgpt": 1.0,
+        "deepseek": 1.0,
+    },
+    "PROVIDER_BURST": 10,
+    
+    # الطابور العادل لطلبات /ask و /analyze و /createpdf
+    "SCHEDULER_SLOTS": 16,  # عدد الطلبات التي تُعالج في نفس الوقت
+    "QUEUE_UPDATE_INTERVAL": 3,  # ثوانٍ بين تحديثات رسالة ترتيب الانتظار
+    
+    # إعادة المحاولة عند الأخطاء المؤقتة (429 و 5xx وانقطاع الاتصال)
+    "RETRY_ATTEMPTS": 3,
+    "RETRY_BASE_DELAY": 1.0,  # ثانية، تتضاعف مع كل محاولة مع عشوائية
+    "RETRY_MAX_DELAY": 30,  # لا يُعاد الطلب إذا طلب المزود انتظاراً أطول
+    
+    # قاطع الدائرة: إيقاف الطلبات لمزود متعطل مؤقتاً
+    "BREAKER_FAILURES": 5,  # عدد الأخطاء المتتالية لفتح الدائرة
+    "BREAKER_COOLDOWN": 30,  # ثوانٍ قبل تجربة المزود مرة أخرى
+    
+    # حد التزامن العام لكل المزودين: ينخفض للنصف عند 429 ويزيد تدريجياً مع النجاح
+    "GOVERNOR_MIN": 2,
+    "GOVERNOR_MAX": 24,
+    
+    # ميزانية الرموز لكل طلب: سياق أكبر يعني دقة أعلى مقابل تكلفة وزمن أكبر
+    "CONTEXT_TOKENS": {  # أقصى رموز لمقاطع المستند المرسلة مع الطلب
+        "gemini": 4000,
+        "chatgpt": 1500,
+        "deepseek": 4000,
+    },
+    "MAX_OUTPUT_TOKENS": {
+        "gemini": 2000,
+        "chatgpt": 2000,
+        "deepseek": 2000,
+    },
+    "USAGE_LOG_SIZE": 200,  # عدد آخر الطلبات المحفوظة في سجل الاستهلاك
 }
 
 # إعداد التسجيل
@@ -47,103 +157,761 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ذاكرة مؤقتة لنتائج PDF (مشتركة مع تطبيق Streamlit عبر القرص)
+pdf_cache = PDFCache()
+
+# ==================== تحديد المعدل والطابور العادل ====================
+class TokenBucket:
+    """دلو رموز: يسمح بدفعة حتى capacity ثم بمعدل rate طلب في الثانية"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def try_acquire(self) -> float:
+        """أخذ رمز إن توفر وإرجاع 0، وإلا إرجاع الثواني المتبقية حتى يتوفر"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    async def acquire(self):
+        """الانتظار حتى يتوفر رمز"""
+        while (wait := self.try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+
+class FairScheduler:
+    """طابور عادل: يُخدم المستخدمون بالتناوب فلا يستحوذ أحدهم على كل الأماكن"""
+    
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.active = 0
+        self.queues: "OrderedDict[int, deque]" = OrderedDict()
+    
+    def _dispatch(self):
+        while self.active < self.slots and self.queues:
+            user_id, queue = next(iter(self.queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+            waiter.set_result(None)
+            self.active += 1
+    
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+    
+    def _remove(self, user_id: int, waiter: asyncio.Future):
+        queue = self.queues.get(user_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[user_id]
+    
+    def position(self, user_id: int, waiter: asyncio.Future) -> int:
+        """ترتيب الطلب في الطابور حسب التناوب (1 = التالي)"""
+        queue = self.queues.get(user_id)
+        if not queue or waiter not in queue:
+            return 0
+        index = queue.index(waiter)
+        position = index + 1
+        before = True
+        for other, other_queue in self.queues.items():
+            if other == user_id:
+                before = False
+                continue
+            position += min(len(other_queue), index + 1 if before else index)
+        return position
+    
+    @asynccontextmanager
+    async def slot(self, user_id: int, on_wait=None):
+        """حجز مكان للمعالجة؛ on_wait(position) تُستدعى كلما تغير الترتيب أثناء الانتظار"""
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user_id, deque()).append(waiter)
+        self._dispatch()
+        
+        try:
+            last_position = None
+            while not waiter.done():
+                position = self.position(user_id, waiter)
+                if on_wait is not None and position != last_position:
+                    await on_wait(position)
+                    last_position = position
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), CONFIG["QUEUE_UPDATE_INTERVAL"])
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if waiter.done():
+                self._release()
+            else:
+                waiter.cancel()
+                self._remove(user_id, waiter)
+            raise
+        
+        try:
+            yield
+        finally:
+            self._release()
+
+
+# ==================== إعادة المحاولة وحماية المزودين ====================
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class ProviderError(Exception):
+    """خطأ من المزود مع رمز الحالة ومدة الانتظار المطلوبة إن وجدت"""
+    
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """قيمة Retry-After بالثواني (تقبل عدد ثوانٍ أو تاريخ HTTP)"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _seconds(value) -> float:
+    """مهلة RetryAfter من Telegram: عدد ثوانٍ أو timedelta حسب إصدار المكتبة"""
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+def classify_error(error: Exception) -> Tuple[Optional[int], bool, Optional[float]]:
+    """(رمز الحالة، هل يُعاد الطلب، مدة الانتظار المطلوبة) لأخطاء المزودين الثلاثة"""
+    if isinstance(error, ProviderError):
+        return error.status, error.status in RETRYABLE_STATUS, error.retry_after
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return None, True, None
+    
+    # أخطاء OpenAI تحمل status_code، وأخطاء Google تحمل code
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if not isinstance(status, int):
+        transient = type(error).__name__ in ("APIConnectionError", "APITimeoutError", "DeadlineExceeded")
+        return None, transient, None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    return status, status in RETRYABLE_STATUS, parse_retry_after(headers.get("retry-after"))
+
+
+def retry_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """تأخير أسي بعشوائية كاملة، ولا يقل عما طلبه المزود"""
+    backoff = random.uniform(0, min(CONFIG["RETRY_MAX_DELAY"], CONFIG["RETRY_BASE_DELAY"] * 2 ** attempt))
+    return max(backoff, retry_after or 0.0)
+
+
+class CircuitBreaker:
+    """يفتح بعد عدد من الأخطاء المتتالية، ثم يسمح بطلب تجريبي واحد كل فترة تهدئة"""
+    
+    def __init__(self, provider: str, failures: int, cooldown: float):
+        self.provider = provider
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+    
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+    
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.cooldown:
+            # طلب تجريبي؛ الطلبات الأخرى تنتظر فترة تهدئة جديدة
+            self.opened_at = now
+            return True
+        return False
+    
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit for {self.provider} closed")
+        self.failures = 0
+        self.opened_at = None
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            if self.opened_at is None:
+                logger.warning(f"Circuit for {self.provider} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+class ConcurrencyGovernor:
+    """حد تزامن عام يتكيف مع التقييد: ينخفض للنصف عند 429 ويزيد ببطء مع كل نجاح"""
+    
+    def __init__(self, minimum: int, maximum: int):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.active = 0
+        self._condition = asyncio.Condition()
+        self._last_throttle = 0.0
+    
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+    
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+    
+    def on_throttle(self):
+        # دفعة من 429 في نفس اللحظة تُحسب تقييداً واحداً
+        now = time.monotonic()
+        if now - self._last_throttle < 1.0:
+            return
+        self._last_throttle = now
+        self.limit = max(float(self.minimum), self.limit / 2)
+        logger.warning(f"Provider throttling, concurrency limit lowered to {int(self.limit)}")
+    
+    def on_success(self):
+        self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+
 # ==================== إعداد النماذج ====================
+class ProviderStats:
+    """زمن الاستجابة ونسبة الأخطاء لآخر الطلبات على نموذج واحد"""
+    
+    def __init__(self, window: int):
+        self.samples: deque = deque(maxlen=window)
+    
+    def record(self, latency: float, ok: bool, cancelled: bool = False):
+        """cancelled: طلب أُلغي قبل اكتماله، فزمنه حد أدنى فقط لزمنه الحقيقي"""
+        self.samples.append((latency, ok, cancelled))
+    
+    def percentile(self, q: float) -> Optional[float]:
+        completed = [latency for latency, ok, cancelled in self.samples if ok and not cancelled]
+        if not completed:
+            return None
+        # الطلب الملغى لا يُحسب أسرع من أبطأ طلب مكتمل، فيرفع التقدير ولا يخفضه أبداً
+        ceiling = max(completed)
+        latencies = sorted(completed + [
+            max(latency, ceiling) for latency, _, cancelled in self.samples if cancelled
+        ])
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+    
+    @property
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ok, _ in self.samples if not ok) / len(self.samples)
+    
+    def to_dict(self) -> Dict:
+        return {
+            "samples": len(self.samples),
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "error_rate": self.error_rate
+        }
+
 class AIModelManager:
     """مدير النماذج الذكية الثلاثة"""
     
     def __init__(self):
         # إعداد Gemini
         genai.configure(api_key=CONFIG["GEMINI_API_KEY"])
-        self.gemini_model = genai.GenerativeModel('gemini-1.5-pro')
+        self.gemini_model = genai.GenerativeModel(
+            'gemini-1.5-pro',
+            generation_config={"max_output_tokens": CONFIG["MAX_OUTPUT_TOKENS"]["gemini"]}
+        )
         
-        # إعداد OpenAI
-        self.openai_client = OpenAI(api_key=CONFIG["OPENAI_API_KEY"])
+        # إعداد OpenAI (عميل غير متزامن حتى لا يتوقف البوت أثناء الانتظار)
+        # إعادة المحاولة تتم بسياسة البوت المشتركة وليس داخل المكتبة
+        self.openai_client = AsyncOpenAI(api_key=CONFIG["OPENAI_API_KEY"], max_retries=0)
         
         # إعداد DeepSeek
         self.deepseek_headers = {
             "Authorization": f"Bearer {CONFIG['DEEPSEEK_API_KEY']}",
             "Content-Type": "application/json"
         }
+        
+        # عميل HTTP مشترك يعيد استخدام الاتصالات (HTTP/2 إن توفرت مكتبة h2)
+        self.http_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=CONFIG["HTTP_MAX_CONNECTIONS"],
+                max_keepalive_connections=CONFIG["HTTP_MAX_KEEPALIVE"],
+                keepalive_expiry=CONFIG["HTTP_KEEPALIVE_EXPIRY"]
+            ),
+            timeout=httpx.Timeout(
+                CONFIG["HTTP_READ_TIMEOUT"],
+                connect=CONFIG["HTTP_CONNECT_TIMEOUT"]
+            )
+        )
+        self.http_stats = {"requests": 0, "new_connections": 0}
+        
+        # ذاكرة دائمة للردود حتى لا يُعاد نفس الطلب على نفس المستند
+        self.response_cache = ResponseCache()
+        
+        # حدود التزامن لكل نموذج
+        self.provider_limits: Dict[str, asyncio.Semaphore] = {
+            provider: asyncio.Semaphore(limit)
+            for provider, limit in CONFIG["PROVIDER_CONCURRENCY"].items()
+        }
+        
+        # حصة الطلبات لكل مزود
+        self.provider_buckets: Dict[str, TokenBucket] = {
+            provider: TokenBucket(rate, CONFIG["PROVIDER_BURST"])
+            for provider, rate in CONFIG["PROVIDER_RATE"].items()
+        }
+        
+        # حماية المزودين من الضغط أثناء الأعطال والتقييد
+        self.breakers: Dict[str, CircuitBreaker] = {
+            provider: CircuitBreaker(provider, CONFIG["BREAKER_FAILURES"], CONFIG["BREAKER_COOLDOWN"])
+            for provider in CONFIG["PROVIDER_CONCURRENCY"]
+        }
+        self.governor = ConcurrencyGovernor(CONFIG["GOVERNOR_MIN"], CONFIG["GOVERNOR_MAX"])
+        
+        # إحصائيات التوجيه التلقائي
+        self.provider_stats: Dict[str, ProviderStats] = {
+            provider: ProviderStats(CONFIG["ROUTER_WINDOW"])
+            for provider in CONFIG["PROVIDER_CONCURRENCY"]
+        }
+        
+        # عدّ الرموز وملء السياق حسب ميزانية كل مزود، وسجل استهلاك كل طلب
+        self.prompts = PromptBuilder(
+            CONFIG["CONTEXT_TOKENS"], CONFIG["MAX_OUTPUT_TOKENS"], usage_log_size=CONFIG["USAGE_LOG_SIZE"]
+        )
     
-    async def process_with_gemini(self, text: str, pdf_text: str = None) -> str:
-        """معالجة النص باستخدام Gemini"""
+    async def _trace_http(self, event_name: str, info: Dict):
+        """عدّ الاتصالات الجديدة لمعرفة نسبة إعادة الاستخدام"""
+        if event_name == "connection.connect_tcp.complete":
+            self.http_stats["new_connections"] += 1
+    
+    async def _post(self, url: str, **kwargs) -> httpx.Response:
+        """إرسال طلب POST عبر العميل المشترك"""
+        self.http_stats["requests"] += 1
+        return await self.http_client.post(url, extensions={"trace": self._trace_http}, **kwargs)
+    
+    def get_http_stats(self) -> Dict:
+        """إحصائيات إعادة استخدام الاتصالات"""
+        requests_count = self.http_stats["requests"]
+        reused = max(requests_count - self.http_stats["new_connections"], 0)
+        return {
+            **self.http_stats,
+            "reused": reused,
+            "reuse_ratio": reused / requests_count if requests_count else 0.0
+        }
+    
+    async def close(self):
+        """إغلاق الاتصالات المفتوحة"""
+        stats = self.get_http_stats()
+        logger.info(
+            f"HTTP: {stats['requests']} requests, {stats['new_connections']} new connections, "
+            f"{stats['reuse_ratio']:.0%} reused"
+        )
+        await self.http_client.aclose()
+    
+    @asynccontextmanager
+    async def _provider_slot(self, provider: str):
+        """انتظار حصة المزود ثم مكان ضمن حدود التزامن، وتسجيل النتيجة في القاطع والحد العام"""
+        breaker = self.breakers[provider]
+        if not breaker.allow():
+            raise ProviderError(f"{provider} غير متاح مؤقتاً بعد أخطاء متكررة")
+        
+        await self.provider_buckets[provider].acquire()
+        # مكان المزود أولاً: الطلبات المنتظرة لمزود مشغول لا تحجز أماكن الحد العام عن غيره
+        async with self.provider_limits[provider], self.governor:
+            try:
+                yield
+            except Exception as e:
+                status, retryable, _ = classify_error(e)
+                if status == 429:
+                    self.governor.on_throttle()
+                if retryable:
+                    breaker.record_failure()
+                raise
+            breaker.record_success()
+            self.governor.on_success()
+    
+    async def _call(self, provider: str, request):
+        """تنفيذ طلب المزود مع إعادة المحاولة عند الأخطاء المؤقتة"""
+        attempts = CONFIG["RETRY_ATTEMPTS"]
+        for attempt in range(attempts):
+            try:
+                async with self._provider_slot(provider), self._track(provider):
+                    return await request()
+            except Exception as e:
+                _, retryable, retry_after = classify_error(e)
+                if not retryable or attempt == attempts - 1 or (retry_after or 0) > CONFIG["RETRY_MAX_DELAY"]:
+                    raise
+                delay = retry_delay(attempt, retry_after)
+                logger.warning(f"{provider} request failed ({e}), retry {attempt + 1}/{attempts - 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+    
+    @asynccontextmanager
+    async def _track(self, provider: str) -> AsyncIterator[None]:
+        """قياس زمن الطلب ونجاحه لإحصائيات التوجيه"""
+        started = time.monotonic()
         try:
-            prompt = f"""
+            yield
+        except asyncio.CancelledError:
+            # طلب خسر السباق: زمنه حد أدنى لزمن النموذج الفعلي
+            self.provider_stats[provider].record(time.monotonic() - started, ok=True, cancelled=True)
+            raise
+        except Exception:
+            self.provider_stats[provider].record(time.monotonic() - started, ok=False)
+            raise
+        self.provider_stats[provider].record(time.monotonic() - started, ok=True)
+    
+    def rank_providers(self) -> List[str]:
+        """ترتيب النماذج: السليمة أولاً ثم الأسرع (p50)، والنماذج بلا عينات كافية تُجرب أولاً"""
+        def score(provider: str):
+            stats = self.provider_stats[provider]
+            if len(stats.samples) < CONFIG["ROUTER_MIN_SAMPLES"]:
+                return (False, 0.0)
+            unhealthy = stats.error_rate > CONFIG["ROUTER_MAX_ERROR_RATE"]
+            return (unhealthy, stats.percentile(0.5) or float("inf"))
+        
+        return sorted(self.provider_stats, key=score)
+    
+    def hedge_delay(self, provider: str) -> float:
+        """مدة الانتظار قبل إرسال نسخة ثانية من الطلب"""
+        stats = self.provider_stats[provider]
+        p95 = stats.percentile(0.95)
+        if len(stats.samples) < CONFIG["ROUTER_MIN_SAMPLES"] or p95 is None:
+            return CONFIG["ROUTER_HEDGE_DELAY"]
+        return max(p95, 1.0)
+    
+    def get_router_stats(self) -> Dict[str, Dict]:
+        return {provider: stats.to_dict() for provider, stats in self.provider_stats.items()}
+    
+    @staticmethod
+    def is_error(answer: str) -> bool:
+        return not answer or not answer.strip() or answer.lstrip().startswith("❌")
+    
+    def _gemini_prompt(self, text: str, pdf_text: str = None) -> str:
+        return f"""
             المستخدم يرسل: {text}
             
             {'='*50}
             {'محتوى PDF مرفق:' if pdf_text else ''}
-            {pdf_text[:3000] if pdf_text else ''}
+            {self.prompts.fit(pdf_text, "gemini") if pdf_text else ''}
             {'='*50}
             
             أجب باللغة العربية ما لم يطلب خلاف ذلك.
             """
+    
+    def _chatgpt_messages(self, text: str, pdf_text: str = None) -> List[Dict]:
+        messages = [
+            {"role": "system", "content": "أنت مساعد مفيد تتحدث العربية."}
+        ]
+        
+        if pdf_text:
+            messages.append({
+                "role": "user", 
+                "content": f"محتوى PDF للتحليل:\n{self.prompts.fit(pdf_text, 'chatgpt')}\n\nالسؤال: {text}"
+            })
+        else:
+            messages.append({"role": "user", "content": text})
+        
+        return messages
+    
+    def _deepseek_payload(self, text: str, pdf_text: str = None) -> Dict:
+        messages = [
+            {"role": "system", "content": "أنت مساعد ذكي يتحدث العربية."},
+            {"role": "user", "content": f"{self.prompts.fit(pdf_text, 'deepseek')}\n\n{text}" if pdf_text else text}
+        ]
+        
+        return {
+            "model": "deepseek-chat",
+            "messages": messages,
+            "max_tokens": self.prompts.max_output("deepseek"),
+            "temperature": 0.7
+        }
+    
+    async def process_with_gemini(self, text: str, pdf_text: str = None, use_cache: bool = True) -> str:
+        """معالجة النص باستخدام Gemini"""
+        try:
+            prompt = self._gemini_prompt(text, pdf_text)
+            
+            cache_key = ResponseCache.make_key("gemini", "gemini-1.5-pro", prompt, pdf_text or "")
+            if use_cache and (cached := self.response_cache.get(cache_key)) is not None:
+                return cached
             
-            response = self.gemini_model.generate_content(prompt)
+            started = time.monotonic()
+            response = await self._call("gemini", lambda: self.gemini_model.generate_content_async(prompt))
+            usage = response.usage_metadata
+            self.prompts.record("gemini", "gemini-1.5-pro", prompt, response.text, time.monotonic() - started,
+                                usage.prompt_token_count, usage.candidates_token_count)
+            self.response_cache.set(cache_key, response.text)
             return response.text
         
         except Exception as e:
             logger.error(f"Gemini error: {e}")
             return f"❌ خطأ في Gemini: {str(e)}"
     
-    async def process_with_chatgpt(self, text: str, pdf_text: str = None) -> str:
+    async def process_with_chatgpt(self, text: str, pdf_text: str = None, use_cache: bool = True) -> str:
         """معالجة النص باستخدام ChatGPT"""
         try:
-            messages = [
-                {"role": "system", "content": "أنت مساعد مفيد تتحدث العربية."}
-            ]
+            messages = self._chatgpt_messages(text, pdf_text)
+            request = json.dumps(messages, ensure_ascii=False)
             
-            if pdf_text:
-                messages.append({
-                    "role": "user", 
-                    "content": f"محتوى PDF للتحليل:\n{pdf_text[:3000]}\n\nالسؤال: {text}"
-                })
-            else:
-                messages.append({"role": "user", "content": text})
+            cache_key = ResponseCache.make_key("chatgpt", "gpt-4", request, pdf_text or "")
+            if use_cache and (cached := self.response_cache.get(cache_key)) is not None:
+                return cached
             
-            response = self.openai_client.chat.completions.create(
+            started = time.monotonic()
+            response = await self._call("chatgpt", lambda: self.openai_client.chat.completions.create(
                 model="gpt-4",
                 messages=messages,
-                max_tokens=2000
-            )
+                max_tokens=self.prompts.max_output("chatgpt")
+            ))
             
-            return response.choices[0].message.content
+            content = response.choices[0].message.content
+            self.prompts.record("chatgpt", "gpt-4", request_text(messages), content, time.monotonic() - started,
+                                response.usage.prompt_tokens, response.usage.completion_tokens)
+            self.response_cache.set(cache_key, content)
+            return content
         
         except Exception as e:
             logger.error(f"ChatGPT error: {e}")
             return f"❌ خطأ في ChatGPT: {str(e)}"
     
-    async def process_with_deepseek(self, text: str, pdf_text: str = None) -> str:
+    async def process_with_deepseek(self, text: str, pdf_text: str = None, use_cache: bool = True) -> str:
         """معالجة النص باستخدام DeepSeek"""
         try:
-            messages = [
-                {"role": "system", "content": "أنت مساعد ذكي يتحدث العربية."},
-                {"role": "user", "content": f"{pdf_text}\n\n{text}" if pdf_text else text}
-            ]
+            payload = self._deepseek_payload(text, pdf_text)
+            request_json = json.dumps(payload, ensure_ascii=False)
             
-            payload = {
-                "model": "deepseek-chat",
-                "messages": messages,
-                "max_tokens": 2000,
-                "temperature": 0.7
-            }
+            cache_key = ResponseCache.make_key("deepseek", "deepseek-chat", request_json, pdf_text or "")
+            if use_cache and (cached := self.response_cache.get(cache_key)) is not None:
+                return cached
             
-            response = requests.post(
-                CONFIG["DEEPSEEK_API_URL"],
-                headers=self.deepseek_headers,
-                json=payload,
-                timeout=60
-            )
+            async def request() -> Dict:
+                response = await self._post(
+                    CONFIG["DEEPSEEK_API_URL"],
+                    headers=self.deepseek_headers,
+                    json=payload
+                )
+                if response.status_code != 200:
+                    raise ProviderError(
+                        f"HTTP {response.status_code}",
+                        response.status_code,
+                        parse_retry_after(response.headers.get("retry-after"))
+                    )
+                return response.json()
             
-            if response.status_code == 200:
-                return response.json()["choices"][0]["message"]["content"]
-            else:
-                return f"❌ خطأ DeepSeek: {response.status_code}"
+            started = time.monotonic()
+            data = await self._call("deepseek", request)
+            content = data["choices"][0]["message"]["content"]
+            usage = data.get("usage", {})
+            self.prompts.record("deepseek", "deepseek-chat", request_text(payload), content, time.monotonic() - started,
+                                usage.get("prompt_tokens"), usage.get("completion_tokens"))
+            self.response_cache.set(cache_key, content)
+            return content
         
         except Exception as e:
             logger.error(f"DeepSeek error: {e}")
             return f"❌ خطأ في DeepSeek: {str(e)}"
     
+    async def _stream_gemini(self, text: str, pdf_text: str, usage: Dict) -> AsyncIterator[str]:
+        prompt = self._gemini_prompt(text, pdf_text)
+        async with self._provider_slot("gemini"), self._track("gemini"):
+            response = await self.gemini_model.generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                # كل جزء يحمل المجاميع حتى لحظته، فيبقى آخرها
+                if chunk.usage_metadata:
+                    usage["input"] = chunk.usage_metadata.prompt_token_count
+                    usage["output"] = chunk.usage_metadata.candidates_token_count
+                if chunk.text:
+                    yield chunk.text
+    
+    async def _stream_chatgpt(self, text: str, pdf_text: str, usage: Dict) -> AsyncIterator[str]:
+        async with self._provider_slot("chatgpt"), self._track("chatgpt"):
+            stream = await self.openai_client.chat.completions.create(
+                model="gpt-4",
+                messages=self._chatgpt_messages(text, pdf_text),
+                max_tokens=self.prompts.max_output("chatgpt"),
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    usage["input"] = chunk.usage.prompt_tokens
+                    usage["output"] = chunk.usage.completion_tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    
+    async def _stream_deepseek(self, text: str, pdf_text: str, usage: Dict) -> AsyncIterator[str]:
+        payload = dict(self._deepseek_payload(text, pdf_text), stream=True, stream_options={"include_usage": True})
+        async with self._provider_slot("deepseek"), self._track("deepseek"):
+            self.http_stats["requests"] += 1
+            async with self.http_client.stream(
+                "POST",
+                CONFIG["DEEPSEEK_API_URL"],
+                headers=self.deepseek_headers,
+                json=payload,
+                extensions={"trace": self._trace_http}
+            ) as response:
+                if response.status_code != 200:
+                    raise ProviderError(
+                        f"DeepSeek HTTP {response.status_code}",
+                        response.status_code,
+                        parse_retry_after(response.headers.get("retry-after"))
+                    )
+                # استجابة SSE: كل سطر بيانات يحمل جزءاً من الرد
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    event = json.loads(data)
+                    if event.get("usage"):
+                        usage["input"] = event["usage"].get("prompt_tokens")
+                        usage["output"] = event["usage"].get("completion_tokens")
+                    if not event.get("choices"):
+                        continue
+                    delta = event["choices"][0]["delta"].get("content")
+                    if delta:
+                        yield delta
+    
+    async def stream(self, model: str, text: str, pdf_text: str = None, use_cache: bool = True) -> AsyncIterator[str]:
+        """بث الرد على أجزاء فور وصولها من النموذج المحدد"""
+        if model == "auto":
+            async for part in self._stream_routed(text, pdf_text, use_cache):
+                yield part
+            return
+        
+        streams = {
+            "gemini": (self._stream_gemini, "gemini-1.5-pro", self._gemini_prompt),
+            "chatgpt": (self._stream_chatgpt, "gpt-4", self._chatgpt_messages),
+            "deepseek": (self._stream_deepseek, "deepseek-chat", self._deepseek_payload),
+        }
+        if model not in streams:
+            yield "❌ النموذج غير معروف"
+            return
+        
+        stream_fn, model_name, build_request = streams[model]
+        built = build_request(text, pdf_text)
+        request = built if isinstance(built, str) else json.dumps(built, ensure_ascii=False)
+        cache_key = ResponseCache.make_key(model, model_name, request, pdf_text or "")
+        if use_cache and (cached := self.response_cache.get(cache_key)) is not None:
+            yield cached
+            return
+        
+        # إعادة المحاولة ممكنة فقط قبل وصول أول جزء إلى المستخدم
+        parts = []
+        usage: Dict = {}
+        started = time.monotonic()
+        attempts = CONFIG["RETRY_ATTEMPTS"]
+        for attempt in range(attempts):
+            try:
+                async for part in stream_fn(text, pdf_text, usage):
+                    parts.append(part)
+                    yield part
+                break
+            except Exception as e:
+                _, retryable, retry_after = classify_error(e)
+                if parts or not retryable or attempt == attempts - 1 or (retry_after or 0) > CONFIG["RETRY_MAX_DELAY"]:
+                    logger.error(f"{model} streaming error: {e}")
+                    yield f"\n❌ خطأ في {model}: {str(e)}"
+                    return
+                delay = retry_delay(attempt, retry_after)
+                logger.warning(f"{model} stream failed ({e}), retry {attempt + 1}/{attempts - 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        
+        response = "".join(parts)
+        self.prompts.record(
+            model, model_name, request_text(built), response, time.monotonic() - started,
+            usage.get("input"), usage.get("output")
+        )
+        self.response_cache.set(cache_key, response)
+    
+    async def _stream_routed(self, text: str, pdf_text: str = None, use_cache: bool = True) -> AsyncIterator[str]:
+        """بث من أفضل نموذج متاح، والانتقال للتالي إذا فشل قبل أن يرسل أي جزء"""
+        error = "❌ لا يوجد نموذج متاح"
+        for provider in self.rank_providers():
+            async with aclosing(self.stream(provider, text, pdf_text, use_cache)) as parts:
+                first = await anext(parts, "")
+                if self.is_error(first):
+                    error = first.strip() or error
+                    logger.warning(f"Router: {provider} failed before streaming, falling back")
+                    continue
+                yield first
+                async for part in parts:
+                    yield part
+                return
+        yield error
+    
+    async def route(self, text: str, pdf_text: str = None, use_cache: bool = True) -> Tuple[str, str]:
+        """إرسال الطلب لأفضل نموذج، مع نسخة احتياطية عند التأخر والانتقال للتالي عند الخطأ
+
+        يُعاد أول رد صالح مع اسم النموذج الذي أرسله، وتُلغى الطلبات الأخرى.
+        """
+        remaining = self.rank_providers()
+        pending: Dict[asyncio.Task, str] = {}
+        error = "❌ لا يوجد نموذج متاح"
+        
+        def launch():
+            provider = remaining.pop(0)
+            task = asyncio.create_task(self.process(provider, text, pdf_text, use_cache))
+            pending[task] = provider
+        
+        try:
+            launch()
+            while pending:
+                timeout = None
+                if CONFIG["ROUTER_HEDGE"] and remaining and len(pending) == 1:
+                    timeout = self.hedge_delay(next(iter(pending.values())))
+                
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info(f"Router: hedging {list(pending.values())} with {remaining[0]}")
+                    launch()
+                    continue
+                
+                for task in done:
+                    provider = pending.pop(task)
+                    answer = task.result()
+                    if not self.is_error(answer):
+                        return provider, answer
+                    error = answer
+                    logger.warning(f"Router: {provider} failed, falling back")
+                
+                if not pending and remaining:
+                    launch()
+            return "", error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def process(self, model: str, text: str, pdf_text: str = None, use_cache: bool = True) -> str:
+        """توجيه الطلب إلى النموذج المحدد"""
+        if model == "auto":
+            _, answer = await self.route(text, pdf_text, use_cache)
+            return answer
+        elif model == "gemini":
+            return await self.process_with_gemini(text, pdf_text, use_cache)
+        elif model == "chatgpt":
+            return await self.process_with_chatgpt(text, pdf_text, use_cache)
+        elif model == "deepseek":
+            return await self.process_with_deepseek(text, pdf_text, use_cache)
+        
+        return "❌ النموذج غير معروف"
+    
     async def generate_pdf_content(self, model: str, topic: str) -> str:
         """إنشاء محتوى لملف PDF بناءً على النموذج المحدد"""
         prompts = {
@@ -158,133 +926,407 @@ class AIModelManager:
             return await self.process_with_chatgpt(prompts["chatgpt"])
         elif model == "deepseek":
             return await self.process_with_deepseek(prompts["deepseek"])
+        elif model == "auto":
+            return await self.process("auto", prompts["gemini"])
         
         return ""
 
 class PDFProcessor:
     """معالج متقدم لملفات PDF"""
     
+    _process_pool: Optional[ProcessPoolExecutor] = None
+    
+    @classmethod
+    def get_process_pool(cls) -> ProcessPoolExecutor:
+        """مجمع عمليات مشترك يُنشأ عند أول ملف كبير"""
+        if cls._process_pool is None:
+            cls._process_pool = ProcessPoolExecutor(max_workers=CONFIG["PDF_WORKERS"])
+        return cls._process_pool
+    
     @staticmethod
-    async def extract_text(pdf_bytes: bytes, max_pages: int = 20) -> str:
-        """استخراج النص من PDF"""
+    async def count_pages(pdf_data: PDFData, pdf_path: Optional[str] = None) -> int:
+        """عدد صفحات المستند دون استخراج أي صفحة"""
+        doc = await asyncio.to_thread(open_pdf, pdf_path or pdf_data)
         try:
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            text_parts = []
-            
-            for page_num in range(min(len(doc), max_pages)):
-                page = doc.load_page(page_num)
-                text = page.get_text()
-                text_parts.append(f"=== صفحة {page_num + 1} ===\n{text}")
-            
+            return len(doc)
+        finally:
             doc.close()
-            return "\n\n".join(text_parts)
-        
-        except Exception as e:
-            logger.error(f"PDF extraction error: {e}")
-            return ""
     
     @staticmethod
-    async def analyze_pdf_structure(pdf_bytes: bytes) -> Dict:
-        """تحليل هيكل PDF"""
+    async def iter_text(
+        pdf_data: PDFData,
+        max_pages: int = 20,
+        result: Optional[PDFIngestResult] = None,
+        sample: bool = False,
+        pdf_path: Optional[str] = None
+    ) -> AsyncIterator[Tuple[int, int, str]]:
+        """استخراج النص صفحة بصفحة وإرجاع (الترتيب، عدد الصفحات، النص) فور جاهزيته
+        
+        يُجمع هيكل المستند (البيانات الوصفية، الخطوط، الصور، الفهرس) في result خلال نفس المرور.
+        إذا تجاوز المستند max_pages تؤخذ الصفحات الأولى، أو عينة موزعة عليه كله عند sample.
+        """
+        result = result if result is not None else PDFIngestResult()
+        cache_key = PDFCache.make_key(document_hash(pdf_data), "ingest", max_pages=max_pages, sample=sample)
+        cached = pdf_cache.get(cache_key)
+        if cached is not None:
+            cached_result = PDFIngestResult.from_dict(cached)
+            for name in PDFIngestResult.__slots__:
+                setattr(result, name, getattr(cached_result, name))
+            for index, text in enumerate(result.pages):
+                yield index, len(result.pages), text
+            return
+        
+        doc = await asyncio.to_thread(open_pdf, pdf_data)
+        page_numbers = select_pages(len(doc), max_pages, sample)
+        page_count = len(page_numbers)
+        started = time.perf_counter()
+        
         try:
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            analysis = {
-                "total_pages": len(doc),
-                "metadata": doc.metadata,
-                "has_images": False,
-                "has_toc": False,
-                "fonts": set()
-            }
-            
-            # تحليل الصفحات
-            for page_num in range(min(5, len(doc))):
-                page = doc.load_page(page_num)
-                
-                # البحث عن صور
-                if page.get_images():
-                    analysis["has_images"] = True
-                
-                # جمع الخطوط
-                fonts = page.get_fonts()
-                for font in fonts:
-                    analysis["fonts"].add(font[3])
-            
-            doc.close()
-            return analysis
+            if page_count >= CONFIG["PARALLEL_MIN_PAGES"] and CONFIG["PDF_WORKERS"] > 1:
+                doc.close()
+                # نطاق واحد لكل عامل، مع إرجاع كل نطاق بالترتيب فور انتهائه. كل عامل
+                # يفتح الملف بمساره على القرص بدل نسخ محتواه إليه
+                loop = asyncio.get_running_loop()
+                pool = PDFProcessor.get_process_pool()
+                with PDFProcessor.spooled_path(pdf_data, pdf_path) as source:
+                    shards = [
+                        loop.run_in_executor(pool, ingest_page_list, source, page_numbers[start:stop])
+                        for start, stop in shard_pages(page_count, CONFIG["PDF_WORKERS"])
+                    ]
+                    for shard_index, shard in enumerate(shards):
+                        shard_result = await shard
+                        if shard_index == 0:
+                            result.total_pages = shard_result.total_pages
+                            result.metadata = shard_result.metadata
+                            result.toc = shard_result.toc
+                        first_index = len(result.pages)
+                        result.merge(shard_result)
+                        for index in range(first_index, len(result.pages)):
+                            yield index, page_count, result.pages[index]
+            else:
+                page_iter = ingest_pages(doc, result, page_numbers)
+                while (text := await asyncio.to_thread(next, page_iter, None)) is not None:
+                    yield len(result.pages) - 1, page_count, text
+        finally:
+            if not doc.is_closed:
+                doc.close()
         
-        except Exception as e:
-            logger.error(f"PDF analysis error: {e}")
-            return {}
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"Extracted {page_count} pages in {elapsed:.2f}s "
+            f"({page_count / elapsed if elapsed else 0:.1f} pages/sec)"
+        )
+        pdf_cache.set(cache_key, result.to_dict())
+    
+    @staticmethod
+    @contextmanager
+    def spooled_path(pdf_data: PDFData, pdf_path: Optional[str] = None):
+        """مسار الملف على القرص لعمليات الاستخراج، مع حفظ الملف المحمل في الذاكرة مؤقتاً"""
+        if pdf_path is not None:
+            yield pdf_path
+            return
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as spool:
+            spool.write(pdf_data)
+            spool.flush()
+            yield spool.name
+    
+    @staticmethod
+    async def ocr_empty_pages(pdf_data: PDFData, result: PDFIngestResult, pdf_path: Optional[str] = None) -> int:
+        """قراءة الصفحات الخالية من النص بالتعرف الضوئي المحلي، صفحة لكل عامل
+        
+        يُرجع عدد الصفحات التي تمت قراءتها.
+        """
+        empty = [index for index, text in enumerate(result.pages) if not text.strip()]
+        if not empty or not CONFIG["OCR_ENABLED"]:
+            return 0
+        if shutil.which("tesseract") is None:
+            logger.warning("Tesseract is not installed; skipping OCR for scanned pages")
+            return 0
+        
+        loop = asyncio.get_running_loop()
+        pool = PDFProcessor.get_process_pool()
+        started = time.perf_counter()
+        
+        # العمال يفتحون الملف بمساره بدل نسخ محتواه لكل صفحة
+        with PDFProcessor.spooled_path(pdf_data, pdf_path) as pdf_path:
+            texts = await asyncio.gather(*(
+                loop.run_in_executor(
+                    pool, ocr_page, pdf_path, result.page_numbers[index],
+                    CONFIG["OCR_LANGUAGE"], CONFIG["OCR_DPI"]
+                )
+                for index in empty
+            ), return_exceptions=True)
+        
+        recognized = 0
+        for index, text in zip(empty, texts):
+            if isinstance(text, Exception):
+                logger.error(f"OCR error on page {result.page_numbers[index] + 1}: {text}")
+            elif text.strip():
+                result.pages[index] = text
+                recognized += 1
+        
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"OCR {len(empty)} pages in {elapsed:.2f}s "
+            f"({len(empty) / elapsed if elapsed else 0:.1f} pages/sec)"
+        )
+        return recognized
+    
+    @staticmethod
+    def join_pages(pages: List[str], page_numbers: Optional[List[int]] = None) -> str:
+        """دمج الصفحات في نص واحد مع علامات الصفحات"""
+        page_numbers = page_numbers or range(len(pages))
+        return "\n\n".join(
+            f"=== صفحة {page_num + 1} ===\n{text}"
+            for page_num, text in zip(page_numbers, pages)
+        )
     
     @staticmethod
-    async def create_pdf_from_text(text: str, filename: str) -> str:
-        """إنشاء ملف PDF من النص"""
+    @asynccontextmanager
+    async def open_download(file, file_size: int):
+        """تحميل الملف إلى الذاكرة، أو إلى ملف مؤقت مربوط بالذاكرة (mmap) إن كان كبيراً
+        
+        يُرجع (عرض المحتوى، مسار الملف أو None).
+        """
+        if file_size <= CONFIG["SPOOL_THRESHOLD"]:
+            buffer = io.BytesIO()
+            await file.download_to_memory(buffer)
+            view = buffer.getbuffer()
+            try:
+                yield view, None
+            finally:
+                view.release()
+            return
+        
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as spool:
+            await file.download_to_memory(spool)
+            spool.flush()
+            with mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield view, spool.name
+                finally:
+                    view.release()
+    
+    @staticmethod
+    async def create_pdf_from_text(text: str, title: str = "مستند مولد من البوت") -> bytes:
+        """إنشاء ملف PDF من النص في الذاكرة (دون ملفات مؤقتة أو برامج خارجية)"""
         try:
-            # طريقة بسيطة باستخدام HTML
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <style>
-                    body {{ font-family: 'Arial', sans-serif; line-height: 1.6; margin: 40px; }}
-                    h1 {{ color: #2c3e50; border-bottom: 2px solid #3498db; }}
-                    .content {{ text-align: right; direction: rtl; }}
-                </style>
-            </head>
-            <body>
-                <div class="content">
-                    <h1>مستند مولد من البوت</h1>
-                    <p>{text.replace(chr(10), '<br>')}</p>
-                </div>
-            </body>
-            </html>
-            """
-            
-            # حفظ HTML مؤقتًا
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.html', delete=False) as f:
-                f.write(html_content)
-                html_path = f.name
-            
-            # تحويل HTML إلى PDF (يتطلب wkhtmltopdf)
-            pdf_path = filename
-            os.system(f"wkhtmltopdf {html_path} {pdf_path}")
-            
-            os.unlink(html_path)
-            return pdf_path
+            return await asyncio.to_thread(render_text, text, title)
         
         except Exception as e:
             logger.error(f"PDF creation error: {e}")
-            return ""
+            return b""
 
 # ==================== إدارة حالة المستخدم ====================
+class MemorySessionBackend:
+    """تخزين الجلسات في الذاكرة مع إخلاء الأقدم حسب المدة وعدد المستخدمين والحجم
+
+    نصوص PDF تُخزن مرة واحدة لكل بصمة محتوى مهما تعدد المستخدمون.
+    """
+    
+    def __init__(self, ttl: int, max_users: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.sessions: "OrderedDict[int, Tuple[float, Dict]]" = OrderedDict()
+        self.documents: Dict[str, str] = {}
+        self.document_refs: Dict[str, int] = {}
+        self.user_documents: Dict[int, str] = {}
+        self.document_bytes = 0
+    
+    def load(self, user_id: int) -> Optional[Dict]:
+        entry = self.sessions.get(user_id)
+        if entry is None:
+            return None
+        now = time.time()
+        if now - entry[0] > self.ttl:
+            self._drop(user_id)
+            return None
+        self.sessions[user_id] = (now, entry[1])
+        self.sessions.move_to_end(user_id)
+        return entry[1]
+    
+    def store(self, user_id: int, session: Dict):
+        self.sessions[user_id] = (time.time(), session)
+        self.sessions.move_to_end(user_id)
+        
+        # تحديث عدد المراجع للنص المرتبط بالجلسة
+        old_hash = self.user_documents.get(user_id, "")
+        new_hash = session.get("pdf_hash", "")
+        if old_hash != new_hash:
+            self._release(old_hash)
+            if new_hash:
+                self.document_refs[new_hash] = self.document_refs.get(new_hash, 0) + 1
+            self.user_documents[user_id] = new_hash
+        
+        self._evict()
+    
+    def load_document(self, doc_hash: str) -> str:
+        return self.documents.get(doc_hash, "")
+    
+    def store_document(self, doc_hash: str, text: str):
+        if doc_hash not in self.documents:
+            self.documents[doc_hash] = text
+            self.document_bytes += len(text.encode("utf-8"))
+    
+    def _release(self, doc_hash: str):
+        if not doc_hash:
+            return
+        self.document_refs[doc_hash] = self.document_refs.get(doc_hash, 1) - 1
+        if self.document_refs[doc_hash] <= 0:
+            del self.document_refs[doc_hash]
+            text = self.documents.pop(doc_hash, "")
+            self.document_bytes -= len(text.encode("utf-8"))
+    
+    def _drop(self, user_id: int):
+        self.sessions.pop(user_id, None)
+        self._release(self.user_documents.pop(user_id, ""))
+    
+    def _evict(self):
+        now = time.time()
+        while self.sessions:
+            user_id, (accessed, _) = next(iter(self.sessions.items()))
+            if (
+                now - accessed > self.ttl
+                or len(self.sessions) > self.max_users
+                or (self.document_bytes > self.max_bytes and len(self.sessions) > 1)
+            ):
+                self._drop(user_id)
+            else:
+                break
+
+
+class SQLiteSessionBackend:
+    """تخزين الجلسات في SQLite حتى تبقى بعد إعادة التشغيل
+
+    نصوص PDF في جدول منفصل بمفتاح بصمة المحتوى، وتُحذف عند عدم ارتباطها بأي جلسة.
+    """
+    
+    def __init__(self, path: str, ttl: int):
+        self.ttl = ttl
+        self.last_cleanup = 0.0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, pdf_hash TEXT, accessed REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents (hash TEXT PRIMARY KEY, text TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_accessed ON sessions (accessed)")
+        self.conn.commit()
+    
+    def load(self, user_id: int) -> Optional[Dict]:
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT data, accessed FROM sessions WHERE user_id = ? AND accessed > ?",
+            (user_id, now - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        # المدة تُحسب من آخر استخدام؛ التحديث مرة في الدقيقة على الأكثر لتقليل الكتابة
+        if now - row[1] > 60:
+            self.conn.execute("UPDATE sessions SET accessed = ? WHERE user_id = ?", (now, user_id))
+            self.conn.commit()
+        return json.loads(row[0])
+    
+    def store(self, user_id: int, session: Dict):
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sessions (user_id, data, pdf_hash, accessed) VALUES (?, ?, ?, ?)",
+            (user_id, json.dumps(session, ensure_ascii=False, default=list), session.get("pdf_hash", ""), now)
+        )
+        if now - self.last_cleanup > 60:
+            self._cleanup(now)
+        self.conn.commit()
+    
+    def load_document(self, doc_hash: str) -> str:
+        row = self.conn.execute("SELECT text FROM documents WHERE hash = ?", (doc_hash,)).fetchone()
+        return row[0] if row else ""
+    
+    def store_document(self, doc_hash: str, text: str):
+        self.conn.execute("INSERT OR IGNORE INTO documents (hash, text) VALUES (?, ?)", (doc_hash, text))
+        self.conn.commit()
+    
+    def _cleanup(self, now: float):
+        self.last_cleanup = now
+        self.conn.execute("DELETE FROM sessions WHERE accessed <= ?", (now - self.ttl,))
+        self.conn.execute(
+            "DELETE FROM documents WHERE hash NOT IN (SELECT pdf_hash FROM sessions WHERE pdf_hash IS NOT NULL)"
+        )
+
+
 class UserSession:
     """إدارة جلسات المستخدمين"""
     
-    def __init__(self):
-        self.sessions: Dict[int, Dict] = {}
+    def __init__(self, backend=None):
+        if backend is None:
+            if CONFIG["SESSION_BACKEND"] == "sqlite":
+                backend = SQLiteSessionBackend(CONFIG["SESSION_DB_PATH"], CONFIG["SESSION_TTL"])
+            else:
+                backend = MemorySessionBackend(
+                    CONFIG["SESSION_TTL"], CONFIG["SESSION_MAX_USERS"], CONFIG["SESSION_MAX_BYTES"]
+                )
+        self.backend = backend
+        # فهارس البحث حسب بصمة المستند، تُعاد بناؤها من النص عند الحاجة
+        self.indexes: "OrderedDict[str, BM25Index]" = OrderedDict()
     
     def get_session(self, user_id: int) -> Dict:
-        if user_id not in self.sessions:
-            self.sessions[user_id] = {
+        session = self.backend.load(user_id)
+        if session is None:
+            session = {
                 "selected_model": "gemini",  # النموذج الافتراضي
-                "last_pdf_text": "",
+                "pdf_hash": "",  # بصمة النص المحفوظ بدلاً من نسخة لكل مستخدم
                 "last_pdf_analysis": {},
+                "last_question": "",
                 "conversation_history": []
             }
-        return self.sessions[user_id]
+            self.backend.store(user_id, session)
+        return session
     
     def update_model(self, user_id: int, model: str):
         session = self.get_session(user_id)
         session["selected_model"] = model
+        self.backend.store(user_id, session)
+    
+    def save_question(self, user_id: int, question: str):
+        session = self.get_session(user_id)
+        session["last_question"] = question
+        self.backend.store(user_id, session)
     
     def save_pdf_text(self, user_id: int, text: str):
         session = self.get_session(user_id)
-        session["last_pdf_text"] = text
+        doc_hash = document_hash(text.encode("utf-8"))
+        self.backend.store_document(doc_hash, text)
+        session["pdf_hash"] = doc_hash
+        self.backend.store(user_id, session)
+        self._get_index(doc_hash, text)
     
     def get_pdf_text(self, user_id: int) -> str:
         session = self.get_session(user_id)
-        return session.get("last_pdf_text", "")
+        doc_hash = session.get("pdf_hash", "")
+        return self.backend.load_document(doc_hash) if doc_hash else ""
+    
+    def get_document_index(self, user_id: int) -> Optional[BM25Index]:
+        """فهرس مقاطع ملف المستخدم لاختيار الأعلى صلة بدلاً من إرسال النص كاملاً"""
+        doc_hash = self.get_session(user_id).get("pdf_hash", "")
+        return self._get_index(doc_hash) if doc_hash else None
+    
+    def _get_index(self, doc_hash: str, text: Optional[str] = None) -> Optional[BM25Index]:
+        if doc_hash in self.indexes:
+            self.indexes.move_to_end(doc_hash)
+            return self.indexes[doc_hash]
+        
+        text = text if text is not None else self.backend.load_document(doc_hash)
+        if not text:
+            return None
+        index = BM25Index.from_text(text)
+        self.indexes[doc_hash] = index
+        while len(self.indexes) > CONFIG["RETRIEVAL_MAX_INDEXES"]:
+            self.indexes.popitem(last=False)
+        return index
 
 # ==================== البوت الرئيسي ====================
 class MultiAIBot:
@@ -293,6 +1335,51 @@ class MultiAIBot:
         self.model_manager = AIModelManager()
         self.pdf_processor = PDFProcessor()
         self.user_sessions = UserSession()
+        self.scheduler = FairScheduler(CONFIG["SCHEDULER_SLOTS"])
+        self.user_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+    
+    async def post_shutdown(self, application: Application):
+        """إغلاق اتصالات النماذج عند إيقاف البوت (Application.builder().post_shutdown)"""
+        await self.model_manager.close()
+    
+    async def _admit(self, message, user_id: int) -> bool:
+        """التحقق من حد الطلبات للمستخدم قبل دخول الطابور"""
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self.user_buckets[user_id] = TokenBucket(CONFIG["USER_RATE"], CONFIG["USER_BURST"])
+            if len(self.user_buckets) > CONFIG["RATE_LIMIT_MAX_USERS"]:
+                self.user_buckets.popitem(last=False)
+        self.user_buckets.move_to_end(user_id)
+        
+        wait = bucket.try_acquire()
+        if wait > 0:
+            await message.reply_text(f"⏳ أرسلت طلبات كثيرة، حاول مرة أخرى بعد {int(wait) + 1} ثانية")
+            return False
+        return True
+    
+    @asynccontextmanager
+    async def _queued(self, message, user_id: int):
+        """انتظار الدور في الطابور العادل مع إبلاغ المستخدم بترتيبه"""
+        notice = None
+        
+        async def on_wait(position: int):
+            nonlocal notice
+            text = f"⏳ طلبك في قائمة الانتظار (الترتيب {position})"
+            try:
+                if notice is None:
+                    notice = await message.reply_text(text)
+                else:
+                    await notice.edit_text(text)
+            except Exception as e:
+                logger.warning(f"Queue notice error: {e}")
+        
+        async with self.scheduler.slot(user_id, on_wait):
+            if notice is not None:
+                try:
+                    await notice.delete()
+                except Exception as e:
+                    logger.warning(f"Queue notice error: {e}")
+            yield
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """بدء البوت وعرض القائمة الرئيسية"""
@@ -323,6 +1410,7 @@ class MultiAIBot:
                 InlineKeyboardButton("🧠 DeepSeek", callback_data="model_deepseek"),
                 InlineKeyboardButton("💬 ChatGPT", callback_data="model_chatgpt")
             ],
+            [InlineKeyboardButton("🧭 اختيار تلقائي", callback_data="model_auto")],
             [
                 InlineKeyboardButton("📊 تحليل PDF", callback_data="analyze_pdf"),
                 InlineKeyboardButton("📝 إنشاء PDF", callback_data="create_pdf")
@@ -359,6 +1447,10 @@ class MultiAIBot:
         - يحتاج اشتراك مدفوع
         - دقيق ومتعدد المهام
         
+        🧭 **تلقائي** (النموذج الحالي: {'✅' if current_model == 'auto' else '☑️'})
+        - يختار الأسرع حالياً وينتقل لغيره عند الخطأ
+        {self._router_summary()}
+        
         **اختر النموذج المناسب لمهمتك:**
         """
         
@@ -367,7 +1459,8 @@ class MultiAIBot:
                 InlineKeyboardButton("🤖 اختيار Gemini", callback_data="model_gemini"),
                 InlineKeyboardButton("🧠 اختيار DeepSeek", callback_data="model_deepseek"),
                 InlineKeyboardButton("💬 اختيار ChatGPT", callback_data="model_chatgpt")
-            ]
+            ],
+            [InlineKeyboardButton("🧭 اختيار تلقائي", callback_data="model_auto")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -377,21 +1470,96 @@ class MultiAIBot:
             reply_markup=reply_markup
         )
     
+    def _router_summary(self) -> str:
+        """زمن الاستجابة ونسبة الأخطاء ومتوسط الرموز الحالية لكل نموذج"""
+        lines = []
+        usage = self.model_manager.prompts.usage.summary()
+        for provider, stats in self.model_manager.get_router_stats().items():
+            if stats["p50"] is None:
+                continue
+            tokens = ""
+            if provider in usage:
+                tokens = f"، رموز {usage[provider]['avg_input']:.0f} دخل / {usage[provider]['avg_output']:.0f} خرج"
+            lines.append(
+                f"- {provider}: p50 {stats['p50']:.1f}s، p95 {stats['p95']:.1f}s، "
+                f"أخطاء {stats['error_rate']:.0%}{tokens}"
+            )
+        http_stats = self.model_manager.get_http_stats()
+        if http_stats["requests"]:
+            lines.append(
+                f"- اتصالات HTTP: {http_stats['requests']} طلب، "
+                f"{http_stats['reuse_ratio']:.0%} عبر اتصال مفتوح"
+            )
+        return "\n        ".join(lines)
+    
     async def handle_pdf(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالجة ملفات PDF المرسلة"""
         user_id = update.effective_user.id
         
         try:
+            # التحقق من الحجم قبل التحميل
+            document = update.message.document
+            file_size = document.file_size or 0
+            if file_size > CONFIG["MAX_FILE_SIZE"]:
+                await update.message.reply_text(
+                    f"❌ حجم الملف ({file_size / 1024 / 1024:.1f}MB) أكبر من الحد المسموح "
+                    f"({CONFIG['MAX_FILE_SIZE'] / 1024 / 1024:.0f}MB)"
+                )
+                return
+            
             await update.message.reply_text("📥 جاري استلام ومعالجة PDF...")
             
             # تحميل الملف
-            file = await update.message.document.get_file()
-            file_bytes = io.BytesIO()
-            await file.download_to_memory(file_bytes)
+            file = await document.get_file()
+            max_pages = CONFIG["MAX_PDF_PAGES"]
+            result = PDFIngestResult()
             
-            # استخراج النص
-            await update.message.reply_text("🔍 جاري استخراج النص من PDF...")
-            extracted_text = await self.pdf_processor.extract_text(file_bytes.getvalue())
+            async with self.pdf_processor.open_download(file, file_size) as (pdf_view, pdf_path):
+                # الرفض قبل أي استخراج، حتى لا تُرسل نطاقات الصفحات إلى العمليات
+                if CONFIG["OVERSIZE_MODE"] == "reject":
+                    total_pages = await self.pdf_processor.count_pages(pdf_view, pdf_path)
+                    if total_pages > max_pages:
+                        await update.message.reply_text(
+                            f"❌ عدد صفحات الملف ({total_pages}) أكبر من الحد المسموح ({max_pages})"
+                        )
+                        return
+                
+                # استخراج النص والهيكل في مرور واحد مع عرض التقدم ومعاينة مبكرة
+                progress_message = await update.message.reply_text("🔍 جاري استخراج النص من PDF...")
+                pages = self.pdf_processor.iter_text(
+                    pdf_view,
+                    max_pages,
+                    result,
+                    sample=CONFIG["OVERSIZE_MODE"] == "sample",
+                    pdf_path=pdf_path
+                )
+                async with aclosing(pages):
+                    async for page_num, page_count, text in pages:
+                        if page_num == 0 and text.strip():
+                            preview = text[:500] + "..." if len(text) > 500 else text
+                            await update.message.reply_text(f"📋 **معاينة الصفحة الأولى:**\n\n{preview}")
+                        elif (page_num + 1) % 10 == 0 and page_num + 1 < page_count:
+                            await progress_message.edit_text(f"🔍 جاري استخراج النص... ({page_num + 1}/{page_count} صفحة)")
+                
+                # الصفحات الممسوحة ضوئياً لا تحتوي نصاً
+                empty_pages = sum(1 for text in result.pages if not text.strip())
+                if empty_pages and CONFIG["OCR_ENABLED"]:
+                    await update.message.reply_text(f"🖼️ {empty_pages} صفحة ممسوحة ضوئياً، جاري التعرف الضوئي على النص...")
+                    await self.pdf_processor.ocr_empty_pages(pdf_view, result, pdf_path)
+            
+            if result.total_pages > max_pages:
+                await update.message.reply_text(
+                    f"ℹ️ الملف يحتوي {result.total_pages} صفحة، تمت معالجة {len(result.pages)} صفحة فقط"
+                    f"{' موزعة على كامل الملف' if CONFIG['OVERSIZE_MODE'] == 'sample' else ''}"
+                )
+            
+            # تنظيف النص مرة واحدة قبل حفظه حتى تستفيد منه كل الطلبات اللاحقة
+            clean_pages, cleaning = normalize_pages(result.pages)
+            logger.info(
+                f"Normalization saved {cleaning['bytes_saved']} bytes, "
+                f"~{cleaning['tokens_saved']} tokens ({cleaning['repeated_lines']} repeated header/footer lines)"
+            )
+            extracted_text = self.pdf_processor.join_pages(clean_pages, result.page_numbers)
             
             if not extracted_text:
                 await update.message.reply_text("❌ لم أتمكن من استخراج النص من الملف")
@@ -400,9 +1568,8 @@ class MultiAIBot:
             # حفظ النص في الجلسة
             self.user_sessions.save_pdf_text(user_id, extracted_text)
             
-            # تحليل الهيكل
-            await update.message.reply_text("📊 جاري تحليل هيكل PDF...")
-            analysis = await self.pdf_processor.analyze_pdf_structure(file_bytes.getvalue())
+            # الهيكل جُمع أثناء استخراج النص
+            analysis = result.analysis()
             
             # عرض النتائج
             summary = f"""
@@ -412,6 +1579,7 @@ class MultiAIBot:
             • عدد الصفحات: {analysis.get('total_pages', 'غير معروف')}
             • يحتوي على صور: {'✅ نعم' if analysis.get('has_images') else '❌ لا'}
             • النص المستخرج: {len(extracted_text)} حرف
+            • تم توفير: {cleaning['tokens_saved']} رمز تقريباً بحذف التكرار والتشكيل
             
             💾 **التخزين:**
             • النص محفوظ في الذاكرة المؤقتة
@@ -436,10 +1604,6 @@ class MultiAIBot:
                 parse_mode='Markdown',
                 reply_markup=reply_markup
             )
-            
-            # إرسال معاينة النص
-            preview = extracted_text[:500] + "..." if len(extracted_text) > 500 else extracted_text
-            await update.message.reply_text(f"📋 **معاينة النص:**\n\n{preview}")
         
         except Exception as e:
             logger.error(f"PDF handling error: {e}")
@@ -448,40 +1612,75 @@ class MultiAIBot:
     async def ask_question(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالجة الأسئلة مع النموذج المحدد"""
         user_id = update.effective_user.id
-        session = self.user_sessions.get_session(user_id)
         
         if not context.args:
             await update.message.reply_text("⚠️ استخدم: /ask سؤالك هنا")
             return
         
         question = " ".join(context.args)
-        pdf_text = session.get("last_pdf_text", "")
-        model = session["selected_model"]
-        
-        await update.message.reply_text(f"🤔 جاري المعالجة مع {model.upper()}...")
+        self.user_sessions.save_question(user_id, question)
+        await self._answer_question(update.message, user_id, question)
+    
+    async def _answer_question(self, message, user_id: int, question: str, use_cache: bool = True):
+        """إرسال السؤال للنموذج المحدد والرد على المستخدم"""
+        if not await self._admit(message, user_id):
+            return
         
-        try:
-            if model == "gemini":
-                response = await self.model_manager.process_with_gemini(question, pdf_text)
-            elif model == "chatgpt":
-                response = await self.model_manager.process_with_chatgpt(question, pdf_text)
-            elif model == "deepseek":
-                response = await self.model_manager.process_with_deepseek(question, pdf_text)
-            else:
-                response = "❌ النموذج غير معروف"
+        async with self._queued(message, user_id):
+            # إرسال المقاطع الأعلى صلة بالسؤال فقط، ضمن ميزانية رموز النموذج
+            model = self.user_sessions.get_session(user_id)["selected_model"]
+            index = self.user_sessions.get_document_index(user_id)
+            pdf_text = self.model_manager.prompts.select(index, question, model) if index else ""
             
-            # تقليم الإجابة إذا كانت طويلة
-            if len(response) > 4000:
-                response = response[:4000] + "\n\n... (النص طويل جداً)"
+            reply = await message.reply_text(f"🤔 جاري المعالجة مع {model.upper()}...")
+            header = f"🤖 **إجابة {model.upper()}:**\n\n"
             
-            await update.message.reply_text(
-                f"🤖 **إجابة {model.upper()}:**\n\n{response}",
-                parse_mode='Markdown'
-            )
-        
-        except Exception as e:
-            logger.error(f"Question processing error: {e}")
-            await update.message.reply_text(f"❌ خطأ في المعالجة: {str(e)}")
+            try:
+                # بث الرد مع تعديل الرسالة على فترات لاحترام حدود التعديل
+                parts = []
+                last_edit = time.monotonic()
+                shown = ""
+                async for part in self.model_manager.stream(model, question, pdf_text, use_cache):
+                    parts.append(part)
+                    if time.monotonic() - last_edit >= CONFIG["STREAM_EDIT_INTERVAL"]:
+                        partial = "".join(parts)[:4000]
+                        last_edit = time.monotonic()
+                        if partial == shown:
+                            continue
+                        # فشل تعديل وسيط لا يوقف الرد: يُؤجل التعديل التالي أو يُتخطى
+                        try:
+                            await reply.edit_text(f"{header}{partial} ▌")
+                            shown = partial
+                        except RetryAfter as e:
+                            last_edit += _seconds(e.retry_after)
+                        except BadRequest as e:
+                            logger.warning(f"Stream edit skipped: {e}")
+                
+                response = "".join(parts)
+                
+                # تقليم الإجابة إذا كانت طويلة
+                if len(response) > 4000:
+                    response = response[:4000] + "\n\n... (النص طويل جداً)"
+                
+                keyboard = [[InlineKeyboardButton("🔄 إجابة جديدة", callback_data="regenerate")]]
+                await self._finish_reply(reply, f"🤖 إجابة {model.upper()}:", response, InlineKeyboardMarkup(keyboard))
+            
+            except Exception as e:
+                logger.error(f"Question processing error: {e}")
+                await message.reply_text(f"❌ خطأ في المعالجة: {str(e)}")
+    
+    async def _finish_reply(self, reply, title: str, response: str, reply_markup):
+        """التعديل الأخير لرسالة الرد؛ يُرسل كنص عادي إذا رفض Telegram تنسيق Markdown في رد النموذج"""
+        for _ in range(3):
+            try:
+                try:
+                    await reply.edit_text(f"**{title}**\n\n{response}", parse_mode='Markdown', reply_markup=reply_markup)
+                except BadRequest as e:
+                    logger.warning(f"Markdown reply rejected, sending plain text: {e}")
+                    await reply.edit_text(f"{title}\n\n{response}", reply_markup=reply_markup)
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(_seconds(e.retry_after))
     
     async def create_pdf_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """إنشاء PDF جديد بناءً على طلب المستخدم"""
@@ -495,36 +1694,37 @@ class MultiAIBot:
         topic = " ".join(context.args)
         model = session["selected_model"]
         
-        await update.message.reply_text(f"📝 جاري إنشاء محتوى عن '{topic}' باستخدام {model}...")
+        if not await self._admit(update.message, user_id):
+            return
         
-        try:
-            # إنشاء المحتوى
-            content = await self.model_manager.generate_pdf_content(model, topic)
-            
-            if not content:
-                await update.message.reply_text("❌ فشل إنشاء المحتوى")
-                return
-            
-            # إنشاء PDF
-            filename = f"generated_{user_id}_{int(datetime.now().timestamp())}.pdf"
-            await update.message.reply_text("🔄 جاري إنشاء ملف PDF...")
+        async with self._queued(update.message, user_id):
+            await update.message.reply_text(f"📝 جاري إنشاء محتوى عن '{topic}' باستخدام {model}...")
             
-            pdf_path = await self.pdf_processor.create_pdf_from_text(content, filename)
-            
-            if os.path.exists(pdf_path):
-                with open(pdf_path, 'rb') as f:
+            try:
+                # إنشاء المحتوى
+                content = await self.model_manager.generate_pdf_content(model, topic)
+                
+                if not content:
+                    await update.message.reply_text("❌ فشل إنشاء المحتوى")
+                    return
+                
+                # إنشاء PDF في الذاكرة وإرساله مباشرة
+                await update.message.reply_text("🔄 جاري إنشاء ملف PDF...")
+                
+                pdf_bytes = await self.pdf_processor.create_pdf_from_text(content, topic)
+                
+                if pdf_bytes:
                     await update.message.reply_document(
-                        document=f,
+                        document=io.BytesIO(pdf_bytes),
                         filename=f"مستند_{topic[:20]}.pdf",
                         caption=f"📄 الملف المولد بواسطة {model.upper()}"
                     )
-                os.remove(pdf_path)
-            else:
-                await update.message.reply_text("❌ فشل إنشاء ملف PDF")
-        
-        except Exception as e:
-            logger.error(f"PDF creation error: {e}")
-            await update.message.reply_text(f"❌ خطأ في الإنشاء: {str(e)}")
+                else:
+                    await update.message.reply_text("❌ فشل إنشاء ملف PDF")
+            
+            except Exception as e:
+                logger.error(f"PDF creation error: {e}")
+                await update.message.reply_text(f"❌ خطأ في الإنشاء: {str(e)}")
     
     async def analyze_pdf(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """تحليل متقدم لملف PDF"""
@@ -535,44 +1735,43 @@ class MultiAIBot:
             await update.message.reply_text("⚠️ لم يتم تحميل أي ملف PDF. أرسل ملف PDF أولاً.")
             return
         
-        await update.message.reply_text("🔬 جاري التحليل المتقدم...")
-        
-        # اختيار النموذج للتحليل
-        session = self.user_sessions.get_session(user_id)
-        model = session["selected_model"]
-        
-        analysis_prompt = f"""
-        قم بتحليل مستند PDF شامل بناءً على المحتوى التالي:
-        
-        {pdf_text[:3000]}
-        
-        **اطلب منك:**
-        1. تلخيص المحتوى الرئيسي
-        2. تحديد المواضيع الأساسية
-        3. اقتراح تحسينات إذا كان المحتوى تقنياً
-        4. تقديم تقييم عام
-        
-        أجب باللغة العربية.
-        """
+        if not await self._admit(update.message, user_id):
+            return
         
-        try:
-            if model == "gemini":
-                analysis = await self.model_manager.process_with_gemini(analysis_prompt)
-            elif model == "chatgpt":
-                analysis = await self.model_manager.process_with_chatgpt(analysis_prompt)
-            elif model == "deepseek":
-                analysis = await self.model_manager.process_with_deepseek(analysis_prompt)
-            else:
-                analysis = "❌ النموذج غير معروف"
+        async with self._queued(update.message, user_id):
+            await update.message.reply_text("🔬 جاري التحليل المتقدم...")
             
-            await update.message.reply_text(
-                f"📊 **تحليل PDF باستخدام {model.upper()}:**\n\n{analysis}",
-                parse_mode='Markdown'
-            )
-        
-        except Exception as e:
-            logger.error(f"Analysis error: {e}")
-            await update.message.reply_text(f"❌ خطأ في التحليل: {str(e)}")
+            # اختيار النموذج للتحليل
+            session = self.user_sessions.get_session(user_id)
+            model = session["selected_model"]
+            
+            # مقاطع موزعة على كامل الملف بقدر ميزانية النموذج بدلاً من بدايته فقط
+            index = self.user_sessions.get_document_index(user_id)
+            document = self.model_manager.prompts.select(index, "", model) if index else pdf_text
+            
+            analysis_prompt = """
+            قم بتحليل مستند PDF شامل بناءً على المحتوى المرفق.
+            
+            **اطلب منك:**
+            1. تلخيص المحتوى الرئيسي
+            2. تحديد المواضيع الأساسية
+            3. اقتراح تحسينات إذا كان المحتوى تقنياً
+            4. تقديم تقييم عام
+            
+            أجب باللغة العربية.
+            """
+            
+            try:
+                analysis = await self.model_manager.process(model, analysis_prompt, document)
+                
+                await update.message.reply_text(
+                    f"📊 **تحليل PDF باستخدام {model.upper()}:**\n\n{analysis}",
+                    parse_mode='Markdown'
+                )
+            
+            except Exception as e:
+                logger.error(f"Analysis error: {e}")
+                await update.message.reply_text(f"❌ خطأ في التحليل: {str(e)}")
     
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالجة ضغطات الأزرار"""
@@ -587,5 +1786,11 @@ class MultiAIBot:
             self.user_sessions.update_model(user_id, model)
             await query.edit_message_text(f"✅ تم اختيار النموذج: **{model.upper()}**", parse_mode='Markdown')
         
+        elif data == "regenerate":
+            # إعادة التوليد تتجاهل الرد المحفوظ
+            session = self.user_sessions.get_session(user_id)
+            if session["last_question"]:
+                await self._answer_question(query.message, user_id, session["last_question"], use_cache=False)
+        
         elif data == "ask_with_pdf":
             keyboard = [[InlineKeyboardButton("📝 كتابة السؤال", switch_inline_query_current_chat="/ask ")]]